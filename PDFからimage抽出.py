@@ -1,8 +1,7 @@
-# pip install PyMuPDF pillow imagehash
-# pip install imagehash
+# pip install PyMuPDF pillow numpy scipy
 import fitz  # PyMuPDF
 from PIL import Image, ImageMath
-import imagehash
+import scipy.fftpack
 import json
 import os
 import datetime
@@ -11,12 +10,32 @@ from collections import defaultdict
 import io
 import numpy as np
 import shutil
+import argparse
+import re
+import multiprocessing
+import queue
+import time
 
 # Define directories
 pdf_dir = r'C:\Users\0127043\OneDrive - ENEOSグループ\練習チャネル\大西テスト\PowerAutomateで画像説明\Pathがある程度固まったので、こちらを実験用に\PDF'  # PDFが配置されているフォルダ
 root_output_dir = os.path.dirname(pdf_dir)  # PDFフォルダと同じ階層
 image_and_json_dir = os.path.join(root_output_dir, "ImageAndJSON")  # メイン出力フォルダ
 
+# 大きな画像を縮小する設定（Noneで無効）
+MAX_IMAGE_PIXELS = 4_000_000  # 出力画像の最大画素数（幅×高さ）
+MAX_IMAGE_BYTES = 5 * 1024 * 1024  # 出力画像の最大ファイルサイズ（バイト）
+MAX_NORMALIZE_ATTEMPTS = 5  # 出力画像がMAX_IMAGE_BYTESを超えた場合に縮小し直す最大回数
+KEEP_ORIGINAL_IMAGES = False  # Trueの場合、縮小前の元画像を「Original」フォルダに残す
+HASH_DRAFT_SIZE = 256  # ハッシュ計算時にJPEGを低解像度でデコードする際の目安サイズ
+HASH_BATCH_SIZE = 64  # パーセプチュアルハッシュをまとめて計算する画像数
+
+# 異常なPDFでバッチ全体が止まらないようにするための設定
+DOCUMENT_TIMEOUT = 1800  # 1文書あたりの制限時間（秒）
+PAGE_TIMEOUT = 300  # 1ページあたりの制限時間（秒）
+MAX_ATTEMPTS = 3  # 1文書あたりの最大試行回数
+PROCESSING_POLICIES = ["full", "raw"]  # 試行ごとの処理設定（raw: マスク合成・縮小・知覚ハッシュを行わない）
+ISOLATE_DOCUMENTS = True  # Falseの場合は同一プロセスで処理する（デバッグ用。タイムアウトは効かない）
+
 # Create main output directory if it doesn't exist
 os.makedirs(image_and_json_dir, exist_ok=True)
 
@@ -26,23 +45,97 @@ print("Starting PDF image extraction process...")
 image_hashes = {}
 binary_hashes = {}
 
-# 画像ハッシュを計算する関数
-def get_image_hash(image_path):
-    # バイナリハッシュ（完全に同じバイナリデータの場合のみ一致）
-    with open(image_path, 'rb') as f:
-        binary_hash = hashlib.md5(f.read()).hexdigest()
+# ハッシュ計算用の縮小画像を作成する関数
+def load_hash_thumbnails(image_path):
+    """
+    phash用(32x32)とdhash用(9x8)のグレースケール画素を作成する
+    JPEGはdraftモードで縮小デコードするため、値は以前のdraftモードの get_image_hash と同じになる
+    （保存されたファイルをそのまま imagehash に渡した値とはJPEGでは一致しないことがある）
+    """
+    with Image.open(image_path) as img:
+        # JPEGは縮小デコードで十分（phash/dhashは最終的に数十pxまで縮小するため）
+        img.draft(None, (HASH_DRAFT_SIZE, HASH_DRAFT_SIZE))
+        gray = img.convert("L")
+    phash_pixels = np.asarray(gray.resize((32, 32), Image.LANCZOS))
+    dhash_pixels = np.asarray(gray.resize((9, 8), Image.LANCZOS))
+    return phash_pixels, dhash_pixels
+
+# 複数画像のphashとdhashをまとめて計算する関数
+def compute_perceptual_hashes(phash_pixels, dhash_pixels):
+    """
+    imagehash.phash / imagehash.dhash と同じ計算方法で、複数画像のハッシュをまとめて求める
+    同じ画素を渡せばビット単位で一致する（JPEGの画素は load_hash_thumbnails のdraftモードでのデコード結果）
     
-    # 画像内容のパーセプチュアルハッシュ（見た目が似ている場合も検出）
-    try:
-        img = Image.open(image_path)
-        # 複数のハッシュアルゴリズムを組み合わせて精度を向上
-        phash = str(imagehash.phash(img))
-        dhash = str(imagehash.dhash(img))
-        combined_hash = f"{phash}_{dhash}"
-        return binary_hash, combined_hash
-    except Exception:
-        # 画像が開けない場合はバイナリハッシュのみ
-        return binary_hash, None
+    Args:
+        phash_pixels (np.ndarray): (枚数, 32, 32) のグレースケール画素
+        dhash_pixels (np.ndarray): (枚数, 8, 9) のグレースケール画素
+    
+    Returns:
+        list: phash（上位64bit）とdhash（下位64bit）を連結した128bitの整数
+    """
+    # 2次元DCTの低周波成分8x8を、その中央値と比較
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(phash_pixels, axis=1), axis=2)
+    low_freq = dct[:, :8, :8].reshape(len(dct), -1)
+    phash_bits = low_freq > np.median(low_freq, axis=1, keepdims=True)
+    
+    # 横方向に隣り合う画素の大小
+    dhash_bits = (dhash_pixels[:, :, 1:] > dhash_pixels[:, :, :-1]).reshape(len(dhash_pixels), -1)
+    
+    # 1画像あたり128bitを先頭ビットが最上位になるよう整数に変換（imagehashの16進表記と同じ順序）
+    packed = np.packbits(np.concatenate([phash_bits, dhash_bits], axis=1), axis=1)
+    return [int.from_bytes(row.tobytes(), "big") for row in packed]
+
+# 画像ハッシュをまとめて計算する関数
+def get_image_hashes(image_data, use_perceptual_hash=True):
+    """
+    Args:
+        image_data (list): 画像データのリスト（"path", "page_number" を含む）
+        use_perceptual_hash (bool): パーセプチュアルハッシュを計算するか
+    
+    Returns:
+        list: 各画像の (バイナリハッシュ, パーセプチュアルハッシュ)
+              ファイルが読めない場合はバイナリハッシュ、画像が開けない場合はパーセプチュアルハッシュがNone
+    """
+    hashes = []
+    for start in range(0, len(image_data), HASH_BATCH_SIZE):
+        batch = image_data[start:start + HASH_BATCH_SIZE]
+        binary_hashes = []
+        thumbnails = []
+        
+        for img_data in batch:
+            report_page_progress(img_data["page_number"])
+            
+            # バイナリハッシュ（完全に同じバイナリデータの場合のみ一致）
+            try:
+                with open(img_data["path"], 'rb') as f:
+                    binary_hashes.append(hashlib.md5(f.read()).hexdigest())
+            except OSError:
+                binary_hashes.append(None)
+            
+            # 画像内容のパーセプチュアルハッシュ用の縮小画像（見た目が似ている場合も検出）
+            thumbnail = None
+            if use_perceptual_hash:
+                try:
+                    thumbnail = load_hash_thumbnails(img_data["path"])
+                except Exception:
+                    # 画像が開けない場合はバイナリハッシュのみ
+                    pass
+            thumbnails.append(thumbnail)
+        
+        perceptual_hashes = [None] * len(batch)
+        loaded = [i for i, thumbnail in enumerate(thumbnails) if thumbnail is not None]
+        if loaded:
+            values = compute_perceptual_hashes(
+                np.stack([thumbnails[i][0] for i in loaded]),
+                np.stack([thumbnails[i][1] for i in loaded])
+            )
+            for i, value in zip(loaded, values):
+                perceptual_hashes[i] = value
+        
+        hashes.extend(zip(binary_hashes, perceptual_hashes))
+    
+    report_page_progress(0)
+    return hashes
 
 # 画像とマスクを適切に合成する関数
 def process_image_with_mask(image_bytes, mask_bytes=None, smask_bytes=None):
@@ -128,6 +221,281 @@ def process_image_with_mask(image_bytes, mask_bytes=None, smask_bytes=None):
         # エラーが発生した場合は元の画像を返す
         return image_bytes, "png"
 
+# 大きすぎる画像を縮小する関数
+def normalize_image(image_bytes, image_ext):
+    """
+    MAX_IMAGE_PIXELS / MAX_IMAGE_BYTES を超える画像を縮小する
+    JPEGはdraftモード、それ以外はreduceで低解像度デコードしてから最終サイズに合わせる
+    
+    Args:
+        image_bytes (bytes): 画像データ
+        image_ext (str): 画像の拡張子
+    
+    Returns:
+        tuple: (画像データ, 拡張子, 縮小情報。縮小しなかった場合はNone)
+    """
+    if not MAX_IMAGE_PIXELS and not MAX_IMAGE_BYTES:
+        return image_bytes, image_ext, None
+    
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        width, height = img.size
+        pixels = width * height
+        
+        # 画素数とファイルサイズの両方から許容画素数を求める
+        max_pixels = pixels
+        if MAX_IMAGE_PIXELS:
+            max_pixels = min(max_pixels, MAX_IMAGE_PIXELS)
+        if MAX_IMAGE_BYTES and len(image_bytes) > MAX_IMAGE_BYTES:
+            max_pixels = min(max_pixels, int(pixels * MAX_IMAGE_BYTES / len(image_bytes)))
+        
+        if pixels == 0 or max_pixels >= pixels:
+            return image_bytes, image_ext, None
+        
+        scale = (max_pixels / pixels) ** 0.5
+        target_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        is_jpeg = img.format == "JPEG"
+        
+        if is_jpeg:
+            # JPEGはDCTの段階で縮小してデコード（target_size以上の最小サイズになる）
+            img.draft(None, target_size)
+        else:
+            factor = int(1 / scale)
+            if factor >= 2:
+                if img.mode not in ("L", "LA", "RGB", "RGBA", "CMYK"):
+                    img = img.convert("RGBA" if img.mode == "P" or "A" in img.getbands() else "RGB")
+                img = img.reduce(factor)
+        
+        # 残りは高品質なリサイズで最終サイズに合わせる
+        if img.size[0] > target_size[0] or img.size[1] > target_size[1]:
+            img = img.resize(target_size, Image.LANCZOS)
+        
+        if not is_jpeg and img.mode == "CMYK":
+            img = img.convert("RGB")
+        output_format = "JPEG" if is_jpeg else "PNG"
+        
+        # 出力サイズが上限に収まるまで縮小し直す（透過の無いPNGはまずJPEGに切り替える）
+        for _ in range(MAX_NORMALIZE_ATTEMPTS):
+            output = io.BytesIO()
+            if output_format == "JPEG":
+                img.save(output, format="JPEG", quality=90)
+            else:
+                img.save(output, format="PNG")
+            encoded_size = img.size
+            output_size = len(output.getvalue())
+            if not MAX_IMAGE_BYTES or output_size <= MAX_IMAGE_BYTES:
+                break
+            if output_format == "PNG" and img.mode in ("RGB", "L"):
+                output_format = "JPEG"
+                continue
+            scale = (MAX_IMAGE_BYTES / output_size) ** 0.5 * 0.9
+            img = img.resize((max(1, int(img.size[0] * scale)), max(1, int(img.size[1] * scale))), Image.LANCZOS)
+        else:
+            print(f"Warning: image is still {output_size} bytes after {MAX_NORMALIZE_ATTEMPTS} attempts (limit {MAX_IMAGE_BYTES})")
+        
+        if output_format == "JPEG":
+            output_ext = image_ext if is_jpeg else "jpeg"
+        else:
+            output_ext = "png"
+        
+        normalization = {
+            "original_width": width,
+            "original_height": height,
+            "original_bytes": len(image_bytes),
+            "original_ext": image_ext,
+            "width": encoded_size[0],
+            "height": encoded_size[1]
+        }
+        return output.getvalue(), output_ext, normalization
+        
+    except Exception as e:
+        print(f"Error normalizing image: {e}")
+        # 縮小に失敗した場合は元の画像を返す
+        return image_bytes, image_ext, None
+
+# スキャンページの領域分割の設定
+SCAN_PAGE_COVERAGE = 0.9  # ページ面積のこの割合以上を1枚の画像が覆い、テキストが無いページをスキャンページとみなす
+SCAN_SEGMENT_DPI = 150  # 領域分割のためにレンダリングする解像度
+SCAN_CROP_DPI = 200  # 切り出した領域を保存する解像度
+SCAN_GRID_CELL = 8  # 連結成分を求めるグリッドの1セルの大きさ（px）
+SCAN_MIN_REGION_RATIO = 0.01  # 領域として扱う最小面積（ページ面積比）
+SCAN_TEXT_LINE_MAX_PT = 24  # これより低い帯の繰り返しだけで構成される領域は本文とみなす（pt）
+SCAN_RULE_MAX_PT = 3  # 罫線とみなす線の最大の太さ（pt）
+
+# テキストを持たず、1枚の画像がページ全体を覆っているページかを判定する関数
+# text_blocks はページのテキストレイアウトインデックス（load_page_text_index）のブロック
+def is_scanned_page(page, text_blocks):
+    if text_blocks:
+        return False
+    page_area = abs(page.rect)
+    if not page_area:
+        return False
+    for info in page.get_image_info():
+        # 画像の位置は回転前の座標のため、表示上の座標（page.rect）に合わせてから比較する
+        if abs((fitz.Rect(info["bbox"]) * page.rotation_matrix) & page.rect) >= page_area * SCAN_PAGE_COVERAGE:
+            return True
+    return False
+
+# 大津の方法で2値化のしきい値を求める関数
+def otsu_threshold(gray):
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    omega = np.cumsum(hist) / gray.size
+    mu = np.cumsum(hist * np.arange(256)) / gray.size
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigma_b = (mu[-1] * omega - mu) ** 2 / (omega * (1 - omega))
+    return int(np.argmax(np.nan_to_num(sigma_b)))
+
+# True が連続する区間の開始位置と長さを返す関数（投影プロファイルの解析用）
+def find_runs(flags):
+    edges = np.diff(np.concatenate(([0], flags.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    return starts, np.flatnonzero(edges == -1) - starts
+
+# 2値グリッドを膨張させる関数
+def dilate_grid(grid, radius_y, radius_x):
+    height, width = grid.shape
+    padded = np.pad(grid, ((radius_y, radius_y), (radius_x, radius_x)))
+    dilated = np.zeros_like(grid)
+    for dy in range(2 * radius_y + 1):
+        for dx in range(2 * radius_x + 1):
+            dilated |= padded[dy:dy + height, dx:dx + width]
+    return dilated
+
+# 2値グリッドの連結成分（8近傍）のバウンディングボックスを求める関数
+def find_connected_components(grid):
+    height, width = grid.shape
+    visited = np.zeros_like(grid)
+    boxes = []
+    for y, x in zip(*np.nonzero(grid)):
+        if visited[y, x]:
+            continue
+        visited[y, x] = True
+        stack = [(y, x)]
+        y0, x0, y1, x1 = y, x, y, x
+        while stack:
+            cy, cx = stack.pop()
+            y0, x0, y1, x1 = min(y0, cy), min(x0, cx), max(y1, cy), max(x1, cx)
+            for ny in range(max(cy - 1, 0), min(cy + 2, height)):
+                for nx in range(max(cx - 1, 0), min(cx + 2, width)):
+                    if grid[ny, nx] and not visited[ny, nx]:
+                        visited[ny, nx] = True
+                        stack.append((ny, nx))
+        boxes.append((int(y0), int(x0), int(y1) + 1, int(x1) + 1))
+    return boxes
+
+# 領域の種類（表・図・本文）を投影プロファイルから判定する関数
+def classify_scan_region(region_ink, text_line_max_px, rule_max_px):
+    # 領域のほぼ全幅（全高）を横切る細い行（列）の並びを罫線とみなす
+    def count_rules(profile):
+        starts, lengths = find_runs(profile >= 0.8)
+        starts, lengths = starts[lengths <= rule_max_px], lengths[lengths <= rule_max_px]
+        # インクの範囲の端にある罫線（枠線）以外を内側の罫線とする
+        inked = np.flatnonzero(profile > 0)
+        if not len(inked):
+            return 0, 0
+        interior = (starts > inked[0] + rule_max_px) & (starts + lengths < inked[-1] + 1 - rule_max_px)
+        return len(starts), int(interior.sum())
+    
+    horizontal_rules, horizontal_interior = count_rules(region_ink.mean(axis=1))
+    vertical_rules, vertical_interior = count_rules(region_ink.mean(axis=0))
+    # 枠で囲まれた図（上下左右の2本ずつ）を表としないよう、内側の罫線を必要とする
+    if horizontal_rules >= 3 or vertical_rules >= 3 or (horizontal_interior >= 1 and vertical_interior >= 1):
+        return "table"
+    
+    # インクのある行の帯がすべて文字の高さ程度なら本文
+    _, bands = find_runs(region_ink.mean(axis=1) > 0.005)
+    if len(bands) and bands.max() <= text_line_max_px:
+        return "text"
+    return "figure"
+
+# スキャンページを図・表・本文の領域に分割する関数
+def segment_scanned_page(page):
+    """
+    スキャンページをレンダリングし、連結成分で領域を求めて投影プロファイルで種類を判定する
+    
+    Args:
+        page: PDF Page object
+    
+    Returns:
+        list: [{"kind": "table" / "figure" / "text", "rect": fitz.Rect}]（ページ座標、上から順）
+    """
+    zoom = SCAN_SEGMENT_DPI / 72
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    gray = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.stride)[:, :pixmap.width]
+    
+    ink = gray <= otsu_threshold(gray)
+    # 白紙や背景が暗いスキャンは分割しない
+    if not 0 < ink.mean() < 0.5:
+        return []
+    
+    # セル単位のグリッドに縮小（ゴミを拾わないように数px以上のインクがあるセルのみ）
+    cell = SCAN_GRID_CELL
+    grid_height, grid_width = -(-ink.shape[0] // cell), -(-ink.shape[1] // cell)
+    padded = np.zeros((grid_height * cell, grid_width * cell), dtype=bool)
+    padded[:ink.shape[0], :ink.shape[1]] = ink
+    grid = padded.reshape(grid_height, cell, grid_width, cell).sum(axis=(1, 3)) >= 3
+    
+    # 文字や行を1つの塊にまとめてから連結成分を求める（横方向は広めに膨張させる）
+    components = find_connected_components(dilate_grid(grid, 2, 3))
+    
+    regions = []
+    min_cells = SCAN_MIN_REGION_RATIO * grid_height * grid_width
+    for gy0, gx0, gy1, gx1 in components:
+        if (gy1 - gy0) * (gx1 - gx0) < min_cells:
+            continue
+        
+        # 膨張前のグリッドで領域を絞り込む
+        ys, xs = np.nonzero(grid[gy0:gy1, gx0:gx1])
+        if not len(ys):
+            continue
+        y0, y1 = (gy0 + ys.min()) * cell, min((gy0 + ys.max() + 1) * cell, ink.shape[0])
+        x0, x1 = (gx0 + xs.min()) * cell, min((gx0 + xs.max() + 1) * cell, ink.shape[1])
+        
+        kind = classify_scan_region(ink[y0:y1, x0:x1], SCAN_TEXT_LINE_MAX_PT * zoom, SCAN_RULE_MAX_PT * zoom)
+        regions.append({"kind": kind, "rect": fitz.Rect(x0 / zoom, y0 / zoom, x1 / zoom, y1 / zoom)})
+    
+    regions.sort(key=lambda region: (region["rect"].y0, region["rect"].x0))
+    return regions
+
+# スキャンページの領域を切り出して保存する関数
+def save_scan_region(page, rect, image_path, padding=5):
+    try:
+        clip = fitz.Rect(rect.x0 - padding, rect.y0 - padding, rect.x1 + padding, rect.y1 + padding) & page.rect
+        # 領域分割と同じく表示上の座標でクリップする（回転したページもそのまま渡す）
+        pixmap = page.get_pixmap(dpi=SCAN_CROP_DPI, clip=clip)
+        pixmap.save(image_path)
+        return True
+    except Exception as e:
+        print(f"Error saving scanned region: {e}")
+        return False
+
+# スキャンページから図の領域を切り出す関数
+def extract_scanned_figures(page, page_number, image_folder, pdf_filename):
+    figure_data = []
+    try:
+        regions = [region for region in segment_scanned_page(page) if region["kind"] == "figure"]
+    except Exception as e:
+        print(f"Error segmenting scanned page {page_number}: {e}")
+        return figure_data
+    
+    print(f"Page {page_number} is a scanned page: found {len(regions)} figure regions")
+    for region_index, region in enumerate(regions):
+        image_filename = "【"+ os.path.splitext(pdf_filename)[0]+"】" + f"page{page_number}_img_scan{region_index}.png"
+        image_path = os.path.join(image_folder, image_filename)
+        rect = region["rect"]
+        if save_scan_region(page, rect, image_path):
+            figure_data.append({
+                "path": image_path,
+                "filename": image_filename,
+                "page_number": page_number,
+                "xref": None,
+                "has_mask": False,
+                "has_smask": False,
+                "original": None,
+                "position": {"x0": rect.x0, "y0": rect.y0, "x1": rect.x1, "y1": rect.y1}
+            })
+    return figure_data
+
 # フォルダ構造を作成する関数
 def create_folder_structure(pdf_filename):
     """
@@ -155,14 +523,34 @@ def create_folder_structure(pdf_filename):
     return doc_folder, image_folder, json_folder
 
 # Function to extract images from PDF with proper mask handling
-def extract_images_from_pdf(pdf_path, image_folder):
+def extract_images_from_pdf(pdf_path, image_folder, policy=None, pages=None, page_text_index=None):
     pdf_document = fitz.open(pdf_path)
     pdf_filename = os.path.basename(pdf_path)
     image_data = []  # List to store image data with page numbers
+    original_folder = os.path.join(os.path.dirname(image_folder), "Original")
+    
+    # 処理設定（タイムアウト後の再試行時はデコードを伴う処理を省略し、問題のページをスキップする）
+    policy = policy or {}
+    raw_mode = policy.get("name") == "raw"
+    skip_pages = set(policy.get("skip_pages", []))
+    if page_text_index is None:
+        page_text_index = build_page_text_index(pdf_path, skip_pages)
     
-    # 各ページから画像を抽出
+    # 各ページから画像を抽出（pagesが指定された場合はそのページのみ）
     for page_num in range(len(pdf_document)):
+        if pages is not None and page_num + 1 not in pages:
+            continue
+        if page_num + 1 in skip_pages:
+            print(f"Skipped page {page_num+1} (timed out in a previous attempt)")
+            continue
+        report_page_progress(page_num + 1)
         page = pdf_document.load_page(page_num)
+        
+        # スキャンページはページ全体の画像ではなく、図の領域のみを切り出す
+        if not raw_mode and is_scanned_page(page, page_text_index.get(str(page_num + 1), [])):
+            image_data.extend(extract_scanned_figures(page, page_num + 1, image_folder, pdf_filename))
+            continue
+        
         image_list = page.get_images(full=True)
         
         for img_index, img in enumerate(image_list):
@@ -197,19 +585,41 @@ def extract_images_from_pdf(pdf_path, image_folder):
                     except Exception as e:
                         print(f"Error extracting smask: {e}")
                 
-                # 画像とマスクを適切に処理
-                processed_image_bytes, processed_ext = process_image_with_mask(
-                    image_bytes, mask_bytes, smask_bytes
-                )
+                if raw_mode:
+                    # 抽出したデータをそのまま保存（デコードしない）
+                    processed_image_bytes, processed_ext, normalization = image_bytes, image_ext, None
+                else:
+                    # 画像とマスクを適切に処理
+                    processed_image_bytes, processed_ext = process_image_with_mask(
+                        image_bytes, mask_bytes, smask_bytes
+                    )
+                    original_image_bytes, original_ext = processed_image_bytes, processed_ext
+                    
+                    # 大きすぎる画像を縮小
+                    processed_image_bytes, processed_ext, normalization = normalize_image(
+                        processed_image_bytes, processed_ext
+                    )
                 
                 # 画像ファイル名を生成
-                image_filename =  "【"+ os.path.splitext(pdf_filename)[0]+"】" + f"page{page_num+1}_img{img_index}.{processed_ext}"
+                image_stem = "【"+ os.path.splitext(pdf_filename)[0]+"】" + f"page{page_num+1}_img{img_index}"
+                image_filename = f"{image_stem}.{processed_ext}"
                 image_path = os.path.join(image_folder, image_filename)
                 
                 # 画像を保存
                 with open(image_path, "wb") as image_file:
                     image_file.write(processed_image_bytes)
                 
+                # 縮小した場合は元画像を別フォルダに残す
+                if normalization and KEEP_ORIGINAL_IMAGES:
+                    os.makedirs(original_folder, exist_ok=True)
+                    original_path = os.path.join(original_folder, f"{image_stem}.{original_ext}")
+                    with open(original_path, "wb") as original_file:
+                        original_file.write(original_image_bytes)
+                    normalization["original_path"] = original_path
+                
+                if normalization:
+                    print(f"Downscaled {image_filename}: {normalization['original_width']}x{normalization['original_height']} -> {normalization['width']}x{normalization['height']}")
+                
                 # 画像情報を記録
                 image_data.append({
                     "path": image_path,
@@ -217,30 +627,57 @@ def extract_images_from_pdf(pdf_path, image_folder):
                     "page_number": page_num + 1,
                     "xref": xref,
                     "has_mask": bool(mask_bytes),
-                    "has_smask": bool(smask_bytes)
+                    "has_smask": bool(smask_bytes),
+                    "original": normalization,
+                    "position": get_image_position(page, xref)
                 })
                 
             except Exception as e:
                 print(f"Error extracting image {img_index} from page {page_num+1}: {e}")
     
+    report_page_progress(0)
     return image_data
 
+# ページ上の画像の配置位置を取得する関数
+def get_image_position(page, xref):
+    try:
+        rects = page.get_image_rects(xref)
+    except Exception:
+        rects = []
+    if not rects:
+        return None
+    rect = rects[0]
+    return {"x0": rect.x0, "y0": rect.y0, "x1": rect.x1, "y1": rect.y1}
+
 # Function to check for duplicates and update metadata
-def process_duplicates(image_data, pdf_filename):
+def process_duplicates(image_data, pdf_filename, use_perceptual_hash=True, known_images=None):
     print("Checking for duplicate images...")
     unique_images = []
     duplicate_info = {}
+    known_images = known_images or []
     
     # ドキュメントごとに重複検出用の辞書をクリア
     local_binary_hashes = {}
     local_image_hashes = {}
     
+    # 前回から再利用する画像を登録しておく（新しく抽出した画像がこれらと重複する場合は削除する）
+    for known_image in known_images:
+        if known_image.get("binary_hash") not in (None, "error_hash"):
+            local_binary_hashes[known_image["binary_hash"]] = known_image["path"]
+        if isinstance(known_image.get("perceptual_hash"), int):
+            local_image_hashes[known_image["perceptual_hash"]] = known_image["path"]
+    
+    # 全画像のハッシュをまとめて計算
+    image_hashes = get_image_hashes(image_data, use_perceptual_hash)
+    
     for i, img_data in enumerate(image_data):
         image_path = img_data["path"]
         page_number = img_data["page_number"]
         
         try:
-            binary_hash, perceptual_hash = get_image_hash(image_path)
+            binary_hash, perceptual_hash = image_hashes[i]
+            if binary_hash is None:
+                raise OSError("could not read image file")
             
             # 重複チェック（同一PDFファイル内のみ）
             is_duplicate = False
@@ -251,7 +688,7 @@ def process_duplicates(image_data, pdf_filename):
                 is_duplicate = True
                 duplicate_reference = local_binary_hashes[binary_hash]
             # 知覚的ハッシュが一致する場合（画像内容が似ている）
-            elif perceptual_hash and perceptual_hash in local_image_hashes:
+            elif perceptual_hash is not None and perceptual_hash in local_image_hashes:
                 is_duplicate = True
                 duplicate_reference = local_image_hashes[perceptual_hash]
             
@@ -264,13 +701,16 @@ def process_duplicates(image_data, pdf_filename):
                     "page_number": page_number
                 })
                 
-                # 重複画像を削除
+                # 重複画像を削除（残しておいた元画像も含む）
                 os.remove(image_path)
+                original_path = (img_data.get("original") or {}).get("original_path")
+                if original_path and os.path.exists(original_path):
+                    os.remove(original_path)
                 print(f"Removed duplicate image: {os.path.basename(image_path)}")
             else:
                 # ユニークな画像として記録
                 local_binary_hashes[binary_hash] = image_path
-                if perceptual_hash:
+                if perceptual_hash is not None:
                     local_image_hashes[perceptual_hash] = image_path
                 
                 # ユニーク画像のデータを保存
@@ -279,8 +719,11 @@ def process_duplicates(image_data, pdf_filename):
                     "filename": img_data["filename"],
                     "page_number": page_number,
                     "binary_hash": binary_hash,
+                    "perceptual_hash": perceptual_hash,
                     "has_mask": img_data.get("has_mask", False),
                     "has_smask": img_data.get("has_smask", False),
+                    "original": img_data.get("original"),
+                    "position": img_data.get("position"),
                     "duplicates": []
                 })
         except Exception as e:
@@ -293,6 +736,8 @@ def process_duplicates(image_data, pdf_filename):
                 "binary_hash": "error_hash",
                 "has_mask": img_data.get("has_mask", False),
                 "has_smask": img_data.get("has_smask", False),
+                "original": img_data.get("original"),
+                "position": img_data.get("position"),
                 "duplicates": []
             })
     
@@ -301,9 +746,12 @@ def process_duplicates(image_data, pdf_filename):
         img_path = img_data["path"]
         if img_path in duplicate_info:
             unique_images[i]["duplicates"] = duplicate_info[img_path]
+    for known_image in known_images:
+        known_image["duplicates"] = known_image.get("duplicates", []) + duplicate_info.get(known_image["path"], [])
     
+    report_page_progress(0)
     print(f"Kept {len(unique_images)} unique images, removed {len(image_data) - len(unique_images)} duplicates")
-    return unique_images
+    return sorted(known_images + unique_images, key=lambda img: img["page_number"])
 
 # Function to collect image metadata and save as JSON
 def save_image_metadata(image_data_list, json_folder, source_pdf):
@@ -313,6 +761,7 @@ def save_image_metadata(image_data_list, json_folder, source_pdf):
             image_filename = image_data["filename"]
             page_number = image_data["page_number"]
             duplicate_info = image_data.get("duplicates", [])
+            context = image_data.get("context") or {}
             
             print(f"Processing image {i+1}/{len(image_data_list)}: {os.path.basename(image_path)} from page {page_number}")
             
@@ -345,6 +794,9 @@ def save_image_metadata(image_data_list, json_folder, source_pdf):
                 "source_pdf": os.path.splitext(source_pdf)[0],
                 "file_name": file_name,
                 "pdf_page_number": page_number,
+                "caption": context.get("caption"),
+                "section_heading": context.get("section_heading"),
+                "surrounding_text": context.get("surrounding_text", ""),
                 "Summary":"",
                 "LinkToSP":""
                 #"duplicate_appearances": duplicate_pages,
@@ -360,6 +812,17 @@ def save_image_metadata(image_data_list, json_folder, source_pdf):
                 #"image_hash": image_data["binary_hash"]
             }
             
+            # 縮小した画像は元画像の情報を記録
+            if image_data.get("original"):
+                original = image_data["original"]
+                json_data["downscaled"] = True
+                json_data["original_image"] = {
+                    "width": original["original_width"],
+                    "height": original["original_height"],
+                    "file_size_bytes": original["original_bytes"],
+                    "file_name": os.path.basename(original["original_path"]) if original.get("original_path") else None
+                }
+            
             # 画像ファイル名と同じ名前でJSONファイルを作成
             json_filename = f"{os.path.splitext(image_filename)[0]}.json"
             json_path = os.path.join(json_folder, json_filename)
@@ -379,46 +842,848 @@ def save_image_metadata(image_data_list, json_folder, source_pdf):
         except Exception as e:
             print(f"Error processing {image_path}: {str(e)}")
 
+# PDFファイル名からシャード番号を決める関数（どのノードでも同じ結果になる）
+def get_shard_index(pdf_filename, num_shards):
+    digest = hashlib.sha1(pdf_filename.encode("utf-8")).hexdigest()
+    return int(digest, 16) % num_shards
+
+# シャードのマニフェストを保存するフォルダ
+def get_shard_manifest_dir():
+    manifest_dir = os.path.join(image_and_json_dir, "_shards")
+    os.makedirs(manifest_dir, exist_ok=True)
+    return manifest_dir
+
+# JSONを一時ファイル経由で書き込む関数（共有フォルダで途中の状態を読まれないようにする）
+def write_json_atomic(json_path, data):
+    temp_path = f"{json_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding='utf-8') as json_file:
+        json.dump(data, json_file, ensure_ascii=False, indent=4)
+    os.replace(temp_path, json_path)
+
+# シャードのマニフェストと重複インデックスを保存する関数
+def save_shard_manifest(shard, documents, failed):
+    """
+    シャード単位の処理結果をマニフェストとして保存する
+    
+    Args:
+        shard (tuple): (シャード番号, シャード数)
+        documents (dict): PDFファイル名 -> ユニーク画像のリスト
+        failed (list): 処理に失敗したPDFファイル名
+    
+    Returns:
+        str: マニフェストのパス
+    """
+    shard_index, num_shards = shard
+    manifest_documents = {}
+    dedup_index = {}
+    
+    for pdf_file, unique_images in documents.items():
+        doc_name = os.path.splitext(pdf_file)[0]
+        records = []
+        for image_data in unique_images:
+            record = {
+                "file_name": image_data["filename"],
+                "page_number": image_data["page_number"],
+                "binary_hash": image_data["binary_hash"],
+                "perceptual_hash": image_data.get("perceptual_hash"),
+                "duplicate_pages": [dup["page_number"] for dup in image_data.get("duplicates", [])]
+            }
+            records.append(record)
+            
+            # 重複インデックス（ハッシュ -> 最初に出現した画像）
+            for key in (record["binary_hash"], record["perceptual_hash"]):
+                if key not in (None, "error_hash") and key not in dedup_index:
+                    dedup_index[key] = {"source_pdf": doc_name, "file_name": record["file_name"]}
+        
+        manifest_documents[pdf_file] = {"source_pdf": doc_name, "records": records}
+    
+    manifest = {
+        "shard": shard_index,
+        "num_shards": num_shards,
+        "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "documents": manifest_documents,
+        "failed": failed,
+        "dedup_index": dedup_index
+    }
+    
+    manifest_path = os.path.join(get_shard_manifest_dir(), f"image_shard_{shard_index}of{num_shards}.json")
+    write_json_atomic(manifest_path, manifest)
+    print(f"Saved shard manifest: {manifest_path}")
+    return manifest_path
+
+# 全シャードのマニフェストを統合し、シャード間の重複を解決する関数
+def merge_shard_manifests(num_shards):
+    """
+    シャードごとのマニフェストを1つに統合する
+    
+    同じハッシュを持つ画像が複数のPDFにある場合は、PDFファイル名順で最初のものを
+    正とし、それ以外を cross_shard_duplicates に記録する（画像ファイル自体は各PDFのフォルダに残す）
+    
+    Args:
+        num_shards (int): シャード数
+    
+    Returns:
+        dict: 統合したマニフェスト（シャードが揃っていない場合はNone）
+    """
+    manifest_dir = get_shard_manifest_dir()
+    manifests = []
+    for shard_index in range(num_shards):
+        manifest_path = os.path.join(manifest_dir, f"image_shard_{shard_index}of{num_shards}.json")
+        if not os.path.exists(manifest_path):
+            print(f"Missing shard manifest: {os.path.basename(manifest_path)}")
+            continue
+        with open(manifest_path, "r", encoding='utf-8') as manifest_file:
+            manifests.append(json.load(manifest_file))
+    
+    if len(manifests) != num_shards:
+        print(f"Found {len(manifests)}/{num_shards} shard manifests. Merge aborted.")
+        return None
+    
+    # シャードごとの隔離リストを統合
+    quarantine = []
+    for shard_index in range(num_shards):
+        quarantine_path = os.path.join(manifest_dir, f"image_quarantine_{shard_index}of{num_shards}.json")
+        if os.path.exists(quarantine_path):
+            with open(quarantine_path, "r", encoding='utf-8') as quarantine_file:
+                quarantine.extend(json.load(quarantine_file))
+    write_json_atomic(os.path.join(image_and_json_dir, "image_quarantine.json"), quarantine)
+    
+    # 各PDFはいずれか1つのシャードに割り当てられる（再実行などで重なった場合は番号の小さいシャードを優先）
+    documents = {}
+    failed = []
+    for manifest in manifests:
+        for pdf_file, document in manifest["documents"].items():
+            if pdf_file in documents:
+                print(f"  {pdf_file} appears in multiple shards; keeping shard {documents[pdf_file]['shard']}")
+                continue
+            documents[pdf_file] = dict(document, shard=manifest["shard"])
+        failed.extend(manifest.get("failed", []))
+    
+    # シャードをまたいだ重複を解決
+    dedup_index = {}
+    cross_shard_duplicates = []
+    for pdf_file in sorted(documents):
+        document = documents[pdf_file]
+        for record in document["records"]:
+            keys = [key for key in (record["binary_hash"], record.get("perceptual_hash")) if key not in (None, "error_hash")]
+            reference = next((dedup_index[key] for key in keys if key in dedup_index), None)
+            if reference and reference["source_pdf"] != document["source_pdf"]:
+                cross_shard_duplicates.append({
+                    "source_pdf": document["source_pdf"],
+                    "file_name": record["file_name"],
+                    "duplicate_of": reference
+                })
+                continue
+            for key in keys:
+                dedup_index.setdefault(key, {"source_pdf": document["source_pdf"], "file_name": record["file_name"]})
+    
+    merged = {
+        "num_shards": num_shards,
+        "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "documents": documents,
+        "failed": sorted(set(failed)),
+        "dedup_index": dedup_index,
+        "cross_shard_duplicates": cross_shard_duplicates,
+        "quarantine": quarantine
+    }
+    
+    merged_path = os.path.join(image_and_json_dir, "image_manifest.json")
+    write_json_atomic(merged_path, merged)
+    print(f"Merged {num_shards} shard manifests ({len(documents)} PDFs, {len(cross_shard_duplicates)} cross-shard duplicates): {merged_path}")
+    return merged
+
+# ページのテキストレイアウトインデックスのキャッシュ（画像抽出と表抽出で共有する）
+# このバージョン・下のパターン・build_page_text_index のブロックの形式は PDFからimage抽出.py と
+# PDFからtable抽出.py で同じものを持っている。片方だけ変えるとお互いのキャッシュを作り直し続けるため、必ず両方を同時に変更すること
+PAGE_TEXT_INDEX_FILENAME = "_page_text_index.json"
+PAGE_TEXT_INDEX_VERSION = 3
+
+# キャプション（「図1…」「表2…」など）と見出しを判定するパターン
+# キャプションは番号の後に区切り（空白・コロン・句点）があるもののみ（「表1に示すとおり…」のような本文は除く）
+CAPTION_PATTERN = re.compile(
+    r"^\s*(図|表|Fig\.?|Figure|Table)\s*[0-9０-９]+([.．\-－][0-9０-９]+)*([\s:：．.](?![0-9０-９])|$)",
+    re.IGNORECASE
+)
+CAPTION_MAX_CHARS = 80
+# 番号付けの見出しは「第1章」「1.」「1.2」のような形のみ（「100 kPa…」「3.5 MPa…」のような本文や「2023.4.1 改訂」のような日付は除く）
+# 番号の無い見出しは build_page_text_index でフォントサイズと太字から判定する
+HEADING_PATTERN = re.compile(
+    r"^\s*(?!(19|20|１９|２０)[0-9０-９]{2}\s*[.．/／]\s*[0-9０-９]{1,2}(?![0-9０-９]))"
+    r"(第\s*[0-9０-９一二三四五六七八九十]+\s*[章節項]"
+    r"|[0-9０-９]+([.．][0-9０-９]+)*[.．](?![0-9０-９])\s*\S"
+    r"|[0-9０-９]+([.．][0-9０-９]+)+\s+[^\s0-9０-９A-Za-z%％°℃.．])"
+)
+
+# ページのテキストレイアウトインデックスを作成する関数
+def build_page_text_index(pdf_path, skip_pages=()):
+    """
+    page.get_text("dict") を1ページ1回だけ実行し、テキストブロックの位置と種類を記録する
+    
+    Args:
+        pdf_path (str): PDFファイルのパス
+        skip_pages (list): 前回の試行でタイムアウトしたためテキストを取得しないページ番号
+    
+    Returns:
+        dict: ページ番号(str) -> テキストブロックのリスト
+    """
+    pdf_document = fitz.open(pdf_path)
+    pages = {}
+    size_counts = defaultdict(int)
+    
+    for page_num in range(len(pdf_document)):
+        if page_num + 1 in skip_pages:
+            pages[str(page_num + 1)] = []
+            continue
+        report_page_progress(page_num + 1)
+        page = pdf_document.load_page(page_num)
+        blocks = []
+        for block in page.get_text("dict").get("blocks", []):
+            # テキストブロック以外（画像ブロック）は対象外
+            if block.get("type", 0) != 0:
+                continue
+            
+            lines = []
+            max_size = 0
+            is_bold = True
+            for line in block.get("lines", []):
+                spans = [span for span in line.get("spans", []) if span.get("text", "").strip()]
+                if not spans:
+                    continue
+                lines.append("".join(span["text"] for span in spans).strip())
+                for span in spans:
+                    size = round(span.get("size", 0), 1)
+                    size_counts[size] += len(span["text"])
+                    max_size = max(max_size, size)
+                    # フラグの16は太字
+                    is_bold = is_bold and bool(span.get("flags", 0) & 16)
+            
+            if not lines:
+                continue
+            
+            blocks.append({
+                "bbox": [round(v, 1) for v in block["bbox"]],
+                "text": " ".join(lines),
+                "size": max_size,
+                "bold": is_bold
+            })
+        
+        # 上から順に並べておく（検索時に上方向の探索を容易にする）
+        blocks.sort(key=lambda b: (b["bbox"][1], b["bbox"][0]))
+        pages[str(page_num + 1)] = blocks
+    
+    report_page_progress(0)
+    pdf_document.close()
+    
+    # 最も文字数の多いフォントサイズを本文サイズとし、見出しとキャプションを判定
+    body_size = max(size_counts, key=size_counts.get) if size_counts else 0
+    for blocks in pages.values():
+        for block in blocks:
+            text = block["text"]
+            block["is_caption"] = len(text) <= CAPTION_MAX_CHARS and bool(CAPTION_PATTERN.match(text))
+            block["is_heading"] = not block["is_caption"] and len(text) <= 60 and (
+                (body_size and block["size"] >= body_size * 1.2)
+                or bool(HEADING_PATTERN.match(text))
+                or (block["bold"] and len(text) <= 30)
+            )
+    
+    return pages
+
+# ページのテキストレイアウトインデックスを読み込む関数（無ければ作成してキャッシュする）
+def load_page_text_index(pdf_path, doc_folder, skip_pages=()):
+    """
+    ドキュメントフォルダにキャッシュしたインデックスを読み込む
+    キャッシュが無い、またはPDFが更新されている場合は作成し直す
+    
+    Args:
+        pdf_path (str): PDFファイルのパス
+        doc_folder (str): ドキュメントフォルダのパス
+        skip_pages (list): テキストを取得しないページ番号
+    
+    Returns:
+        dict: ページ番号(str) -> テキストブロックのリスト
+    """
+    stat = os.stat(pdf_path)
+    source = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "version": PAGE_TEXT_INDEX_VERSION,
+        "skipped_pages": sorted(skip_pages)
+    }
+    index_path = os.path.join(doc_folder, PAGE_TEXT_INDEX_FILENAME)
+    
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "r", encoding='utf-8') as index_file:
+                cached = json.load(index_file)
+            if cached.get("source") == source:
+                print(f"Loaded page text index: {index_path}")
+                return cached["pages"]
+        except Exception as e:
+            print(f"Error loading page text index: {e}")
+    
+    pages = build_page_text_index(pdf_path, skip_pages)
+    write_json_atomic(index_path, {"source": source, "pages": pages})
+    print(f"Created page text index: {index_path}")
+    return pages
+
+# 図表の周辺のキャプション・見出し・本文を取得する関数
+def get_artifact_context(page_text_index, page_number, position, caption_prefix, artifact_rects=None, margin=100, max_chars=400):
+    """
+    図表の位置に最も近いキャプション、直前の見出し、周辺の本文を取得する
+    
+    Args:
+        page_text_index (dict): load_page_text_index の戻り値
+        page_number (int): ページ番号（1始まり）
+        position (dict): 図表の位置 {"x0", "y0", "x1", "y1"}（不明な場合はNone）
+        caption_prefix (str): 優先するキャプションの接頭辞（"図" または "表"）
+        artifact_rects (dict): ページ番号 -> 図表の位置のリスト（この中のテキストは見出しとみなさない）
+        margin (float): 周辺の本文として扱う上下の距離（pt）
+        max_chars (int): 周辺の本文の最大文字数
+    
+    Returns:
+        dict: {"caption", "section_heading", "surrounding_text"}
+    """
+    blocks = page_text_index.get(str(page_number), [])
+    top = position["y0"] if position else float("inf")
+    artifact_rects = artifact_rects or {}
+    
+    def is_heading(block, page):
+        # 表のヘッダーセルなど、図表の内側にあるテキストは見出しとしない
+        cx, cy = (block["bbox"][0] + block["bbox"][2]) / 2, (block["bbox"][1] + block["bbox"][3]) / 2
+        return block["is_heading"] and not any(
+            rect["x0"] <= cx <= rect["x1"] and rect["y0"] <= cy <= rect["y1"]
+            for rect in artifact_rects.get(page, [])
+        )
+    
+    # 直前の見出し（同じページに無ければ前のページを遡る）
+    section_heading = next((b["text"] for b in reversed(blocks) if is_heading(b, page_number) and b["bbox"][3] <= top), None)
+    previous_page = page_number - 1
+    while section_heading is None and previous_page >= 1:
+        section_heading = next((b["text"] for b in reversed(page_text_index.get(str(previous_page), [])) if is_heading(b, previous_page)), None)
+        previous_page -= 1
+    
+    if not position:
+        return {"caption": None, "section_heading": section_heading, "surrounding_text": ""}
+    
+    x0, y0, x1, y1 = position["x0"], position["y0"], position["x1"], position["y1"]
+    
+    def vertical_gap(bbox):
+        return max(bbox[1] - y1, y0 - bbox[3], 0)
+    
+    def overlaps_horizontally(bbox):
+        return bbox[0] < x1 and bbox[2] > x0
+    
+    def is_inside(bbox):
+        # ブロックの中心が図表の内側にあれば図表自体のテキストとみなす
+        cx, cy = (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
+        return x0 <= cx <= x1 and y0 <= cy <= y1
+    
+    # 最も近いキャプション（同じ種類を優先）
+    captions = [b for b in blocks if b["is_caption"] and not is_inside(b["bbox"]) and vertical_gap(b["bbox"]) <= margin]
+    captions.sort(key=lambda b: (
+        not b["text"].lstrip().startswith(caption_prefix),
+        not overlaps_horizontally(b["bbox"]),
+        vertical_gap(b["bbox"])
+    ))
+    caption = captions[0]["text"] if captions else None
+    
+    # 周辺の本文（近い順）
+    nearby = [
+        b for b in blocks
+        if not b["is_caption"] and not b["is_heading"] and not is_inside(b["bbox"])
+        and overlaps_horizontally(b["bbox"]) and vertical_gap(b["bbox"]) <= margin
+    ]
+    nearby.sort(key=lambda b: vertical_gap(b["bbox"]))
+    surrounding_text = ""
+    for block in nearby:
+        if len(surrounding_text) >= max_chars:
+            break
+        surrounding_text = f"{surrounding_text} {block['text']}".strip()
+    
+    return {
+        "caption": caption,
+        "section_heading": section_heading,
+        "surrounding_text": surrounding_text[:max_chars]
+    }
+
+# ページ単位の前回の処理結果（改訂版PDFで変更の無いページの成果物を再利用するために保存する）
+PAGE_STATE_FILENAME = "_page_state_image.json"
+
+# 各ページの内容からフィンガープリントを計算する関数
+def compute_page_fingerprints(pdf_path, page_text_index, skip_pages=()):
+    """
+    コンテンツストリーム・画像データ・テキストのハッシュから各ページのフィンガープリントを計算する
+    画像はxref番号ではなくデータのハッシュを使うため、改訂でxrefが振り直されても一致する
+    テキストはページのテキストレイアウトインデックスから取得する（テキストの抽出は1ページ1回のみ）
+    
+    Args:
+        pdf_path (str): PDFファイルのパス
+        page_text_index (dict): load_page_text_index の戻り値
+        skip_pages (list): 前回の試行でタイムアウトしたため計算しないページ番号
+    
+    Returns:
+        dict: ページ番号(str) -> フィンガープリント（計算できなかったページ・スキップしたページはNone）
+    """
+    pdf_document = fitz.open(pdf_path)
+    image_digests = {}
+    fingerprints = {}
+    
+    for page_num in range(len(pdf_document)):
+        if page_num + 1 in skip_pages:
+            fingerprints[str(page_num + 1)] = None
+            continue
+        report_page_progress(page_num + 1)
+        try:
+            page = pdf_document.load_page(page_num)
+            content_hash = hashlib.md5(page.read_contents()).hexdigest()
+            
+            # ページ内の画像（とSMask）のデータのハッシュ
+            page_images = []
+            for img in page.get_images(full=True):
+                for xref in (img[0], img[1]):
+                    if xref and xref not in image_digests:
+                        image_digests[xref] = hashlib.md5(pdf_document.xref_stream_raw(xref)).hexdigest()
+                page_images.append([image_digests[img[0]], image_digests.get(img[1])])
+            
+            text_blocks = [[block["bbox"], block["text"]] for block in page_text_index.get(str(page_num + 1), [])]
+            text_hash = hashlib.md5(json.dumps(text_blocks, ensure_ascii=False).encode("utf-8")).hexdigest()
+            signature = [content_hash, page_images, text_hash, list(page.rect), page.rotation]
+            fingerprints[str(page_num + 1)] = hashlib.md5(json.dumps(signature).encode("utf-8")).hexdigest()
+        except Exception as e:
+            print(f"Error fingerprinting page {page_num+1}: {e}")
+            fingerprints[str(page_num + 1)] = None
+    
+    report_page_progress(0)
+    pdf_document.close()
+    return fingerprints
+
+# 前回の処理結果を読み込む関数
+def load_page_state(doc_folder):
+    state_path = os.path.join(doc_folder, PAGE_STATE_FILENAME)
+    if not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path, "r", encoding='utf-8') as state_file:
+            return json.load(state_file)
+    except Exception as e:
+        print(f"Error loading page state: {e}")
+        return None
+
+# 今回の処理結果を保存する関数
+def save_page_state(doc_folder, page_fingerprints, records, policy_name):
+    write_json_atomic(os.path.join(doc_folder, PAGE_STATE_FILENAME), {
+        "policy": policy_name,
+        "page_count": len(page_fingerprints),
+        "pages": page_fingerprints,
+        "records": records
+    })
+
+# 前回の処理結果と比較し、成果物を再利用できるページを求める関数
+def find_reusable_pages(page_fingerprints, previous_state, policy_name, image_folder):
+    """
+    同じページ番号でフィンガープリントが一致し、成果物が残っているページを再利用対象とする
+    
+    Args:
+        page_fingerprints (dict): compute_page_fingerprints の戻り値
+        previous_state (dict): load_page_state の戻り値
+        policy_name (str): 今回の処理設定（前回と異なる場合は再利用しない）
+        image_folder (str): 成果物の画像フォルダ
+    
+    Returns:
+        set: 再利用できるページ番号
+    """
+    if not previous_state or previous_state.get("policy") != policy_name:
+        return set()
+    
+    previous_pages = previous_state.get("pages", {})
+    reusable_pages = {
+        int(page) for page, fingerprint in page_fingerprints.items()
+        if fingerprint and previous_pages.get(page) == fingerprint
+    }
+    
+    records = previous_state.get("records", [])
+    for record in records:
+        if not os.path.exists(os.path.join(image_folder, record["filename"])):
+            reusable_pages.discard(record["page_number"])
+    
+    # 重複として削除した画像は別ページの画像を参照しているため、
+    # 参照先・参照元のどちらかのページを処理し直す場合は両方とも処理し直す
+    changed = True
+    while changed:
+        changed = False
+        for record in records:
+            pages = {record["page_number"]} | {dup["page_number"] for dup in record.get("duplicates", [])}
+            if pages & reusable_pages and not pages <= reusable_pages:
+                reusable_pages -= pages
+                changed = True
+    
+    return reusable_pages
+
+# 図表の位置をページごとにまとめる関数（見出しの判定から図表の内側のテキストを除くため）
+def collect_artifact_rects(doc_folder, records):
+    """
+    今回の記録と、画像抽出・表抽出それぞれの前回の処理結果（_page_state_*.json）から図表の位置を集める
+    
+    Returns:
+        dict: ページ番号 -> 図表の位置のリスト
+    """
+    all_records = list(records)
+    for state_kind in ("image", "table"):
+        state_path = os.path.join(doc_folder, f"_page_state_{state_kind}.json")
+        if not os.path.exists(state_path):
+            continue
+        try:
+            with open(state_path, "r", encoding='utf-8') as state_file:
+                all_records.extend(json.load(state_file).get("records", []))
+        except Exception as e:
+            print(f"Error loading {os.path.basename(state_path)}: {e}")
+    
+    artifact_rects = defaultdict(list)
+    for record in all_records:
+        if record.get("position"):
+            artifact_rects[record["page_number"]].append(record["position"])
+    return artifact_rects
+
+# 1つのPDFを処理する関数
+def process_document(pdf_dir, pdf_file, policy=None):
+    """
+    PDFから画像を抽出し、重複を除いてメタデータを保存する
+    
+    Args:
+        pdf_dir (str): PDFが配置されているフォルダ
+        pdf_file (str): PDFファイル名
+        policy (dict): 処理設定 {"name": PROCESSING_POLICIESの値, "skip_pages": スキップするページ番号}
+    
+    Returns:
+        list: ユニークな画像のリスト
+    """
+    policy = policy or {"name": "full", "skip_pages": []}
+    pdf_path = os.path.join(pdf_dir, pdf_file)
+    print(f"\n{'='*60}\nProcessing PDF: {pdf_file}")
+    
+    # フォルダ構造を作成
+    doc_folder, image_folder, json_folder = create_folder_structure(pdf_file)
+    print(f"Created folders:\n  Document: {doc_folder}\n  Image: {image_folder}\n  JSON: {json_folder}")
+    
+    # スキップするページについて、前回の試行で出力された画像を削除
+    skip_pages = policy.get("skip_pages", [])
+    for page_number in skip_pages:
+        remove_page_artifacts(image_folder, json_folder, pdf_file, page_number)
+    
+    # ページのフィンガープリントを前回の処理結果と比較し、変更の無いページは画像とJSONを再利用
+    page_text_index = load_page_text_index(pdf_path, doc_folder, skip_pages)
+    page_fingerprints = compute_page_fingerprints(pdf_path, page_text_index, skip_pages)
+    previous_state = load_page_state(doc_folder)
+    reusable_pages = find_reusable_pages(page_fingerprints, previous_state, policy["name"], image_folder)
+    reused_images = []
+    if previous_state:
+        reused_images = [
+            dict(record, path=os.path.join(image_folder, record["filename"]))
+            for record in previous_state.get("records", [])
+            if record["page_number"] in reusable_pages
+        ]
+        # 処理し直すページの古い画像を削除
+        for page_number in range(1, max(previous_state.get("page_count", 0), len(page_fingerprints)) + 1):
+            if page_number not in reusable_pages:
+                remove_page_artifacts(image_folder, json_folder, pdf_file, page_number)
+    pages_to_process = {int(page) for page in page_fingerprints} - reusable_pages
+    if reusable_pages:
+        print(f"Reusing {len(reused_images)} images from {len(reusable_pages)} unchanged pages, processing {len(pages_to_process)} pages")
+    
+    # PDFから画像を抽出
+    image_data_list = extract_images_from_pdf(pdf_path, image_folder, policy, pages_to_process, page_text_index)
+    print(f"Extracted {len(image_data_list)} images from {pdf_file}")
+    
+    # 重複チェックと処理
+    unique_images = process_duplicates(
+        image_data_list, pdf_file, use_perceptual_hash=policy.get("name") != "raw", known_images=reused_images
+    )
+    
+    # 新しく抽出した画像のみJSONを作成する（再利用する画像はJSONが無くなっている場合のみ）
+    reused_paths = {image_data["path"] for image_data in reused_images}
+    new_images = [
+        image_data for image_data in unique_images
+        if image_data["path"] not in reused_paths
+        or not os.path.exists(os.path.join(json_folder, f"{os.path.splitext(image_data['filename'])[0]}.json"))
+    ]
+    
+    # ページのテキストから各画像のキャプション・見出し・周辺の本文を取得
+    if new_images:
+        artifact_rects = collect_artifact_rects(doc_folder, image_data_list + reused_images)
+        for image_data in new_images:
+            image_data["context"] = get_artifact_context(
+                page_text_index, image_data["page_number"], image_data.get("position"), "図", artifact_rects
+            )
+    
+    # 各画像のメタデータをJSONファイルとして保存
+    save_image_metadata(new_images, json_folder, pdf_file)
+    
+    # 次回の改訂版との比較用に処理結果を保存（スキップしたページは次回必ず処理する）
+    processed_fingerprints = {
+        page: (None if int(page) in skip_pages else fingerprint) for page, fingerprint in page_fingerprints.items()
+    }
+    save_page_state(doc_folder, processed_fingerprints, unique_images, policy["name"])
+    return unique_images
+
+# ワーカープロセス内で現在処理中のページを親プロセスに知らせるための共有配列
+_page_progress = None
+
+# 処理中のページ番号を記録する関数（0はページ処理外）
+def report_page_progress(page_number):
+    if _page_progress is not None:
+        _page_progress[0] = page_number
+        _page_progress[1] = time.time()
+
+# 前回の試行で途中まで出力された、スキップ対象ページの成果物を削除する関数
+def remove_page_artifacts(image_folder, json_folder, pdf_file, page_number):
+    prefix = f"【{os.path.splitext(pdf_file)[0]}】page{page_number}_img"
+    original_folder = os.path.join(os.path.dirname(image_folder), "Original")
+    for folder in (image_folder, json_folder, original_folder):
+        if not os.path.isdir(folder):
+            continue
+        for file_name in os.listdir(folder):
+            if file_name.startswith(prefix):
+                os.remove(os.path.join(folder, file_name))
+                print(f"Removed partial output: {file_name}")
+
+# 失敗した試行で出力された成果物を削除する関数（再試行・隔離の前に呼ぶ）
+def remove_attempt_artifacts(pdf_file, attempt_start):
+    """
+    試行の開始以降に書き込まれた画像・JSON・元画像を削除する
+    強制終了された試行が残したファイル（同じ名前で拡張子の異なる画像、スキャンページの切り出し画像など）が
+    再試行後の成果物に混ざらないようにする（それ以前の処理で出力された成果物は再利用のために残す）
+    
+    Args:
+        pdf_file (str): PDFファイル名
+        attempt_start (float): 試行を開始した時刻（time.time()）
+    """
+    doc_name = os.path.splitext(pdf_file)[0]
+    doc_folder = os.path.join(image_and_json_dir, doc_name)
+    if not os.path.isdir(doc_folder):
+        return
+    
+    # ファイルの更新時刻は時計より粗い精度で記録されるため、余裕を持たせて比較する
+    written_since = attempt_start - 2.0
+    pattern = re.compile(rf"^{re.escape(f'【{doc_name}】')}page\d+_img")
+    for folder_name in ("Image", "JSON", "Original"):
+        folder = os.path.join(doc_folder, folder_name)
+        if not os.path.isdir(folder):
+            continue
+        for file_name in os.listdir(folder):
+            file_path = os.path.join(folder, file_name)
+            if pattern.match(file_name) and os.path.getmtime(file_path) >= written_since:
+                os.remove(file_path)
+                print(f"Removed output of failed attempt: {file_name}")
+
+# ワーカープロセスで1つのPDFを処理する関数
+def document_worker(pdf_dir, pdf_file, output_dir, policy, progress, result_queue):
+    global image_and_json_dir, _page_progress
+    image_and_json_dir = output_dir
+    _page_progress = progress
+    try:
+        result_queue.put(("ok", process_document(pdf_dir, pdf_file, policy)))
+    except Exception as e:
+        result_queue.put(("error", str(e)))
+
+# 1つのPDFを別プロセスで処理し、制限時間を超えたら強制終了する関数
+def run_document_in_subprocess(pdf_dir, pdf_file, policy):
+    """
+    Returns:
+        tuple: (結果の種類, 内容)
+            ("ok", ユニークな画像のリスト) / ("error", エラー内容) / ("crashed", 終了コード)
+            ("page_timeout", ページ番号) / ("document_timeout", 処理中だったページ番号)
+    """
+    progress = multiprocessing.Array("d", [0, 0.0])
+    result_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=document_worker,
+        args=(pdf_dir, pdf_file, image_and_json_dir, policy, progress, result_queue)
+    )
+    process.start()
+    start_time = time.time()
+    
+    try:
+        while True:
+            try:
+                # 結果はプロセス終了前に受け取る（大きな結果でキューが詰まらないようにする）
+                result = result_queue.get(timeout=1.0)
+                process.join()
+                return result
+            except queue.Empty:
+                pass
+            
+            if not process.is_alive():
+                process.join()
+                try:
+                    return result_queue.get(timeout=1.0)
+                except queue.Empty:
+                    return "crashed", process.exitcode
+            
+            now = time.time()
+            page_number, page_start = int(progress[0]), progress[1]
+            if page_number and now - page_start > PAGE_TIMEOUT:
+                print(f"Page {page_number} of {pdf_file} exceeded {PAGE_TIMEOUT}s. Killing worker...")
+                return "page_timeout", page_number
+            if now - start_time > DOCUMENT_TIMEOUT:
+                print(f"{pdf_file} exceeded {DOCUMENT_TIMEOUT}s. Killing worker...")
+                return "document_timeout", page_number
+    finally:
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+# 制限時間を設けてPDFを処理し、失敗した場合は低コストの設定で再試行する関数
+def process_document_with_watchdog(pdf_dir, pdf_file):
+    """
+    PROCESSING_POLICIES の順に設定を下げながら最大 MAX_ATTEMPTS 回試行する
+    タイムアウトしたページは次の試行からスキップする
+    
+    Returns:
+        tuple: (ユニークな画像のリスト（失敗した場合はNone）, 隔離リストのエントリ（問題が無ければNone）)
+    """
+    skip_pages = []
+    attempts = []
+    
+    for attempt in range(MAX_ATTEMPTS):
+        policy = {
+            "name": PROCESSING_POLICIES[min(attempt, len(PROCESSING_POLICIES) - 1)],
+            "skip_pages": list(skip_pages)
+        }
+        if attempt > 0:
+            print(f"Retrying {pdf_file} with policy '{policy['name']}' (skip pages: {skip_pages or 'none'})")
+        
+        attempt_start = time.time()
+        if ISOLATE_DOCUMENTS:
+            status, detail = run_document_in_subprocess(pdf_dir, pdf_file, policy)
+        else:
+            try:
+                status, detail = "ok", process_document(pdf_dir, pdf_file, policy)
+            except Exception as e:
+                status, detail = "error", str(e)
+        
+        if status == "ok":
+            quarantine_entry = None
+            if skip_pages:
+                quarantine_entry = {
+                    "source_pdf": pdf_file,
+                    "status": "partial",
+                    "skipped_pages": skip_pages,
+                    "attempts": attempts,
+                    "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                }
+            return detail, quarantine_entry
+        
+        print(f"Attempt {attempt+1} for {pdf_file} failed: {status} ({detail})")
+        attempts.append({"policy": policy["name"], "result": status, "detail": detail})
+        remove_attempt_artifacts(pdf_file, attempt_start)
+        if status in ("page_timeout", "document_timeout") and detail and detail not in skip_pages:
+            skip_pages.append(detail)
+    
+    return None, {
+        "source_pdf": pdf_file,
+        "status": "failed",
+        "skipped_pages": skip_pages,
+        "attempts": attempts,
+        "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+# 処理に問題があったPDFを隔離リストとして保存する関数
+def save_quarantine(quarantine, shard=None):
+    if shard:
+        shard_index, num_shards = shard
+        quarantine_path = os.path.join(get_shard_manifest_dir(), f"image_quarantine_{shard_index}of{num_shards}.json")
+    else:
+        quarantine_path = os.path.join(image_and_json_dir, "image_quarantine.json")
+    write_json_atomic(quarantine_path, quarantine)
+    print(f"Saved quarantine list ({len(quarantine)} PDFs): {quarantine_path}")
+
 # フォルダ内の全PDFファイルを処理
-def process_pdf_folder(pdf_dir):
+def process_pdf_folder(pdf_dir, shard=None):
+    """
+    フォルダ内のPDFファイルを処理する
+    
+    Args:
+        pdf_dir (str): PDFが配置されているフォルダ
+        shard (tuple): (シャード番号, シャード数)。指定時は担当分のPDFのみ処理し、マニフェストを保存する
+    """
     # PDFフォルダ内のPDFファイルを検索
-    pdf_files = [f for f in os.listdir(pdf_dir) if f.lower().endswith('.pdf')]
+    pdf_files = sorted(f for f in os.listdir(pdf_dir) if f.lower().endswith('.pdf'))
+    
+    if shard:
+        shard_index, num_shards = shard
+        pdf_files = [f for f in pdf_files if get_shard_index(f, num_shards) == shard_index]
+        print(f"Shard {shard_index}/{num_shards}: assigned {len(pdf_files)} PDF files")
     
     if not pdf_files:
         print(f"No PDF files found in {pdf_dir}")
+        if shard:
+            save_shard_manifest(shard, {}, [])
+            save_quarantine([], shard)
         return
     
     print(f"Found {len(pdf_files)} PDF files to process")
     
-    # 各PDFファイルを処理
+    # シャードのマニフェスト用に処理結果を記録
+    documents = {}
+    failed = []
+    quarantine = []
+    
+    # 各PDFファイルを処理（1文書ずつ別プロセスで実行し、時間がかかりすぎる場合は打ち切る）
     for pdf_file in pdf_files:
         try:
-            pdf_path = os.path.join(pdf_dir, pdf_file)
-            print(f"\n{'='*60}\nProcessing PDF: {pdf_file}")
-            
-            # フォルダ構造を作成
-            doc_folder, image_folder, json_folder = create_folder_structure(pdf_file)
-            print(f"Created folders:\n  Document: {doc_folder}\n  Image: {image_folder}\n  JSON: {json_folder}")
-            
-            # PDFから画像を抽出
-            image_data_list = extract_images_from_pdf(pdf_path, image_folder)
-            print(f"Extracted {len(image_data_list)} images from {pdf_file}")
-            
-            # 重複チェックと処理
-            unique_images = process_duplicates(image_data_list, pdf_file)
-            
-            # 各画像のメタデータをJSONファイルとして保存
-            save_image_metadata(unique_images, json_folder, pdf_file)
+            unique_images, quarantine_entry = process_document_with_watchdog(pdf_dir, pdf_file)
+            if quarantine_entry:
+                quarantine.append(quarantine_entry)
+            if unique_images is None:
+                print(f"Quarantined PDF {pdf_file}")
+                failed.append(pdf_file)
+            else:
+                documents[pdf_file] = unique_images
             
         except Exception as e:
             print(f"Error processing PDF {pdf_file}: {str(e)}")
+            failed.append(pdf_file)
+    
+    save_quarantine(quarantine, shard)
+    if shard:
+        save_shard_manifest(shard, documents, failed)
+
+# "i/N" 形式のシャード指定を解析する関数
+def parse_shard(value):
+    try:
+        shard_index, num_shards = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}' (expected i/N)")
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}' (0 <= i < N)")
+    return shard_index, num_shards
 
 # メイン処理
 if __name__ == "__main__":
+    # exe化した場合にワーカープロセスを起動できるようにする
+    multiprocessing.freeze_support()
+    
+    parser = argparse.ArgumentParser(description="PDFから画像を抽出し、JSONメタデータを作成する")
+    parser.add_argument("pdf_dir", nargs="?", default=pdf_dir, help="PDFが配置されているフォルダ")
+    parser.add_argument("--shard", type=parse_shard, help="担当シャード（i/N 形式、iは0始まり）")
+    parser.add_argument("--merge-shards", type=int, metavar="N", help="N個のシャードのマニフェストを統合する")
+    args = parser.parse_args()
+    
+    # 引数でフォルダが指定された場合は出力先も合わせる
+    if args.pdf_dir != pdf_dir:
+        pdf_dir = args.pdf_dir
+        root_output_dir = os.path.dirname(os.path.abspath(pdf_dir))
+        image_and_json_dir = os.path.join(root_output_dir, "ImageAndJSON")
+        os.makedirs(image_and_json_dir, exist_ok=True)
+    
     try:
-        # フォルダ内の全PDFを処理
-        process_pdf_folder(pdf_dir)
-        print("\nProcessing complete. All PDFs have been processed.")
-        print(f"Results are saved in: {image_and_json_dir}")
+        if args.merge_shards:
+            # シャードのマニフェストを統合
+            merge_shard_manifests(args.merge_shards)
+        else:
+            # フォルダ内の全PDFを処理
+            process_pdf_folder(pdf_dir, shard=args.shard)
+            print("\nProcessing complete. All PDFs have been processed.")
+            print(f"Results are saved in: {image_and_json_dir}")
     except Exception as e:
         print(f"Error during processing: {e}")
\ No newline at end of file
@@ -13,12 +13,25 @@ import io
 import shutil
 from pathlib import Path
 from PIL import Image
+import numpy as np
+import argparse
+import re
+import multiprocessing
+import queue
+import time
 
 # Define directories
 pdf_dir = r'C:\Users\0127043\OneDrive - ENEOSグループ\練習チャネル\大西テスト\PowerAutomateで画像説明\Pathがある程度固まったので、こちらを実験用に\PDF'  # PDFが配置されているフォルダ
 root_output_dir = os.path.dirname(pdf_dir)  # PDFフォルダと同じ階層
 table_and_json_dir = os.path.join(root_output_dir, "ImageAndJSON")  # メイン出力フォルダ
 
+# 異常なPDFでバッチ全体が止まらないようにするための設定
+DOCUMENT_TIMEOUT = 1800  # 1文書あたりの制限時間（秒）
+PAGE_TIMEOUT = 300  # 1ページあたりの制限時間（秒）
+MAX_ATTEMPTS = 3  # 1文書あたりの最大試行回数
+PROCESSING_POLICIES = ["full", "detection_only"]  # 試行ごとの処理設定（detection_only: 代替の表検出とページ全体の画像化を行わない）
+ISOLATE_DOCUMENTS = True  # Falseの場合は同一プロセスで処理する（デバッグ用。タイムアウトは効かない）
+
 # Create main output directory if it doesn't exist
 os.makedirs(table_and_json_dir, exist_ok=True)
 
@@ -32,6 +45,68 @@ def get_image_hash(image_path):
     
     return binary_hash
 
+# 表の内容からフィンガープリントを計算する関数（レンダリング前の重複判定用）
+def get_table_fingerprint(table):
+    """
+    セルのテキストと行列構造から表のフィンガープリントを計算する
+    セルの位置は含めない（位置のずれは is_same_table_geometry で許容範囲内かを確認する）
+    
+    Args:
+        table: PyMuPDFのTableオブジェクト
+    
+    Returns:
+        str: フィンガープリント（テキストが取れない場合はNone）
+    """
+    try:
+        rows = table.extract() if hasattr(table, "extract") else []
+    except Exception:
+        rows = []
+    
+    # セルテキストを正規化（前後の空白除去・連続空白の圧縮）
+    cell_texts = [
+        [" ".join(str(cell).split()) if cell is not None else "" for cell in row]
+        for row in rows
+    ]
+    
+    # テキストが全く無い表は内容で区別できないため、レンダリング後のハッシュに任せる
+    if not any(text for row in cell_texts for text in row):
+        return None
+    
+    signature = {
+        "rows": len(cell_texts),
+        "columns": max((len(row) for row in cell_texts), default=0),
+        "cells": cell_texts
+    }
+    return hashlib.md5(json.dumps(signature, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+# 表の左上を原点としたセル境界と表の大きさを求める関数（ページ上の位置には依存しない）
+def get_table_geometry(table, rect):
+    cells = []
+    for cell in getattr(table, "cells", None) or []:
+        if cell is None:
+            cells.append(None)
+            continue
+        x0, y0, x1, y1 = cell[:4]
+        cells.append([round(x0 - rect.x0, 2), round(y0 - rect.y0, 2), round(x1 - rect.x0, 2), round(y1 - rect.y0, 2)])
+    return {"size": [round(rect.width, 2), round(rect.height, 2)], "cells": cells}
+
+# 2つの表のジオメトリが許容範囲内で一致するかを判定する関数
+def is_same_table_geometry(geometry, other, tolerance=2.0):
+    """
+    表の大きさと各セル境界の差がすべて tolerance（pt）以内なら同じ表とみなす
+    ジオメトリが無い場合（前のバージョンで記録した表など）は一致しないものとする
+    """
+    if not geometry or not other or len(geometry["cells"]) != len(other["cells"]):
+        return False
+    if any(abs(a - b) > tolerance for a, b in zip(geometry["size"], other["size"])):
+        return False
+    for cell, other_cell in zip(geometry["cells"], other["cells"]):
+        if (cell is None) != (other_cell is None):
+            return False
+        if cell is not None and any(abs(a - b) > tolerance for a, b in zip(cell, other_cell)):
+            return False
+    return True
+
 # フォルダ構造を作成する関数
 def create_folder_structure(pdf_filename):
     """
@@ -95,15 +170,250 @@ def save_table_as_image(page, rect, image_path, dpi=300):
         print(f"Error saving table as image: {e}")
         return False
 
+# スキャンページの領域分割の設定
+SCAN_PAGE_COVERAGE = 0.9  # ページ面積のこの割合以上を1枚の画像が覆い、テキストが無いページをスキャンページとみなす
+SCAN_SEGMENT_DPI = 150  # 領域分割のためにレンダリングする解像度
+SCAN_CROP_DPI = 200  # 切り出した領域を保存する解像度
+SCAN_GRID_CELL = 8  # 連結成分を求めるグリッドの1セルの大きさ（px）
+SCAN_MIN_REGION_RATIO = 0.01  # 領域として扱う最小面積（ページ面積比）
+SCAN_TEXT_LINE_MAX_PT = 24  # これより低い帯の繰り返しだけで構成される領域は本文とみなす（pt）
+SCAN_RULE_MAX_PT = 3  # 罫線とみなす線の最大の太さ（pt）
+
+# テキストを持たず、1枚の画像がページ全体を覆っているページかを判定する関数
+# text_blocks はページのテキストレイアウトインデックス（load_page_text_index）のブロック
+def is_scanned_page(page, text_blocks):
+    if text_blocks:
+        return False
+    page_area = abs(page.rect)
+    if not page_area:
+        return False
+    for info in page.get_image_info():
+        # 画像の位置は回転前の座標のため、表示上の座標（page.rect）に合わせてから比較する
+        if abs((fitz.Rect(info["bbox"]) * page.rotation_matrix) & page.rect) >= page_area * SCAN_PAGE_COVERAGE:
+            return True
+    return False
+
+# 大津の方法で2値化のしきい値を求める関数
+def otsu_threshold(gray):
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    omega = np.cumsum(hist) / gray.size
+    mu = np.cumsum(hist * np.arange(256)) / gray.size
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigma_b = (mu[-1] * omega - mu) ** 2 / (omega * (1 - omega))
+    return int(np.argmax(np.nan_to_num(sigma_b)))
+
+# True が連続する区間の開始位置と長さを返す関数（投影プロファイルの解析用）
+def find_runs(flags):
+    edges = np.diff(np.concatenate(([0], flags.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    return starts, np.flatnonzero(edges == -1) - starts
+
+# 2値グリッドを膨張させる関数
+def dilate_grid(grid, radius_y, radius_x):
+    height, width = grid.shape
+    padded = np.pad(grid, ((radius_y, radius_y), (radius_x, radius_x)))
+    dilated = np.zeros_like(grid)
+    for dy in range(2 * radius_y + 1):
+        for dx in range(2 * radius_x + 1):
+            dilated |= padded[dy:dy + height, dx:dx + width]
+    return dilated
+
+# 2値グリッドの連結成分（8近傍）のバウンディングボックスを求める関数
+def find_connected_components(grid):
+    height, width = grid.shape
+    visited = np.zeros_like(grid)
+    boxes = []
+    for y, x in zip(*np.nonzero(grid)):
+        if visited[y, x]:
+            continue
+        visited[y, x] = True
+        stack = [(y, x)]
+        y0, x0, y1, x1 = y, x, y, x
+        while stack:
+            cy, cx = stack.pop()
+            y0, x0, y1, x1 = min(y0, cy), min(x0, cx), max(y1, cy), max(x1, cx)
+            for ny in range(max(cy - 1, 0), min(cy + 2, height)):
+                for nx in range(max(cx - 1, 0), min(cx + 2, width)):
+                    if grid[ny, nx] and not visited[ny, nx]:
+                        visited[ny, nx] = True
+                        stack.append((ny, nx))
+        boxes.append((int(y0), int(x0), int(y1) + 1, int(x1) + 1))
+    return boxes
+
+# 領域の種類（表・図・本文）を投影プロファイルから判定する関数
+def classify_scan_region(region_ink, text_line_max_px, rule_max_px):
+    # 領域のほぼ全幅（全高）を横切る細い行（列）の並びを罫線とみなす
+    def count_rules(profile):
+        starts, lengths = find_runs(profile >= 0.8)
+        starts, lengths = starts[lengths <= rule_max_px], lengths[lengths <= rule_max_px]
+        # インクの範囲の端にある罫線（枠線）以外を内側の罫線とする
+        inked = np.flatnonzero(profile > 0)
+        if not len(inked):
+            return 0, 0
+        interior = (starts > inked[0] + rule_max_px) & (starts + lengths < inked[-1] + 1 - rule_max_px)
+        return len(starts), int(interior.sum())
+    
+    horizontal_rules, horizontal_interior = count_rules(region_ink.mean(axis=1))
+    vertical_rules, vertical_interior = count_rules(region_ink.mean(axis=0))
+    # 枠で囲まれた図（上下左右の2本ずつ）を表としないよう、内側の罫線を必要とする
+    if horizontal_rules >= 3 or vertical_rules >= 3 or (horizontal_interior >= 1 and vertical_interior >= 1):
+        return "table"
+    
+    # インクのある行の帯がすべて文字の高さ程度なら本文
+    _, bands = find_runs(region_ink.mean(axis=1) > 0.005)
+    if len(bands) and bands.max() <= text_line_max_px:
+        return "text"
+    return "figure"
+
+# スキャンページを図・表・本文の領域に分割する関数
+def segment_scanned_page(page):
+    """
+    スキャンページをレンダリングし、連結成分で領域を求めて投影プロファイルで種類を判定する
+    
+    Args:
+        page: PDF Page object
+    
+    Returns:
+        list: [{"kind": "table" / "figure" / "text", "rect": fitz.Rect}]（ページ座標、上から順）
+    """
+    zoom = SCAN_SEGMENT_DPI / 72
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    gray = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.stride)[:, :pixmap.width]
+    
+    ink = gray <= otsu_threshold(gray)
+    # 白紙や背景が暗いスキャンは分割しない
+    if not 0 < ink.mean() < 0.5:
+        return []
+    
+    # セル単位のグリッドに縮小（ゴミを拾わないように数px以上のインクがあるセルのみ）
+    cell = SCAN_GRID_CELL
+    grid_height, grid_width = -(-ink.shape[0] // cell), -(-ink.shape[1] // cell)
+    padded = np.zeros((grid_height * cell, grid_width * cell), dtype=bool)
+    padded[:ink.shape[0], :ink.shape[1]] = ink
+    grid = padded.reshape(grid_height, cell, grid_width, cell).sum(axis=(1, 3)) >= 3
+    
+    # 文字や行を1つの塊にまとめてから連結成分を求める（横方向は広めに膨張させる）
+    components = find_connected_components(dilate_grid(grid, 2, 3))
+    
+    regions = []
+    min_cells = SCAN_MIN_REGION_RATIO * grid_height * grid_width
+    for gy0, gx0, gy1, gx1 in components:
+        if (gy1 - gy0) * (gx1 - gx0) < min_cells:
+            continue
+        
+        # 膨張前のグリッドで領域を絞り込む
+        ys, xs = np.nonzero(grid[gy0:gy1, gx0:gx1])
+        if not len(ys):
+            continue
+        y0, y1 = (gy0 + ys.min()) * cell, min((gy0 + ys.max() + 1) * cell, ink.shape[0])
+        x0, x1 = (gx0 + xs.min()) * cell, min((gx0 + xs.max() + 1) * cell, ink.shape[1])
+        
+        kind = classify_scan_region(ink[y0:y1, x0:x1], SCAN_TEXT_LINE_MAX_PT * zoom, SCAN_RULE_MAX_PT * zoom)
+        regions.append({"kind": kind, "rect": fitz.Rect(x0 / zoom, y0 / zoom, x1 / zoom, y1 / zoom)})
+    
+    regions.sort(key=lambda region: (region["rect"].y0, region["rect"].x0))
+    return regions
+
+# スキャンページの領域を切り出して保存する関数
+def save_scan_region(page, rect, image_path, padding=5):
+    try:
+        clip = fitz.Rect(rect.x0 - padding, rect.y0 - padding, rect.x1 + padding, rect.y1 + padding) & page.rect
+        # 領域分割と同じく表示上の座標でクリップする（回転したページもそのまま渡す）
+        pixmap = page.get_pixmap(dpi=SCAN_CROP_DPI, clip=clip)
+        pixmap.save(image_path)
+        return True
+    except Exception as e:
+        print(f"Error saving scanned region: {e}")
+        return False
+
+# スキャンページから表の領域を切り出す関数
+def extract_scanned_tables(page, page_number, table_folder, pdf_filename):
+    table_data = []
+    try:
+        regions = [region for region in segment_scanned_page(page) if region["kind"] == "table"]
+    except Exception as e:
+        print(f"Error segmenting scanned page {page_number}: {e}")
+        return table_data
+    
+    print(f"Page {page_number} is a scanned page: found {len(regions)} table regions")
+    for table_index, region in enumerate(regions):
+        table_image_filename = f"【{os.path.splitext(pdf_filename)[0]}】page{page_number}_scan_table{table_index+1}.png"
+        image_path = os.path.join(table_folder, table_image_filename)
+        rect = region["rect"]
+        if save_scan_region(page, rect, image_path):
+            table_data.append({
+                "image_path": image_path,
+                "filename": table_image_filename,
+                "page_number": page_number,
+                "position": {
+                    "x0": rect.x0,
+                    "y0": rect.y0,
+                    "x1": rect.x1,
+                    "y1": rect.y1
+                },
+                "extraction_method": "scan_segment",
+                "duplicates": []
+            })
+    return table_data
+
 # PyMuPDFを使用して表を抽出し画像として保存する関数
-def extract_tables_with_pymupdf(pdf_path, table_folder):
+def extract_tables_with_pymupdf(pdf_path, table_folder, policy=None, pages=None, known_tables=None, page_text_index=None, previous_mode=None):
+    """
+    PDFから表を検出して画像として保存する
+    標準の方法で表が見つからない場合は、文書全体に対して別のアプローチ（alternative）、
+    ページ全体の画像化（full_page）の順にフォールバックする
+    
+    Args:
+        pages (set): 処理するページ番号（Noneの場合は全ページ）
+        known_tables (list): 前回から再利用する表（重複判定とフォールバックの判定に含める）
+        previous_mode (str): 再利用する表を抽出した時のフォールバックの種類
+            今回の判定結果と異なる場合は、再利用する表と整合しないためフォールバックを行わずに戻る
+    
+    Returns:
+        tuple: (表データのリスト, フォールバックの種類 "standard" / "alternative" / "full_page" / "none")
+    """
     pdf_document = fitz.open(pdf_path)
     pdf_filename = os.path.basename(pdf_path)
     table_data = []
     
-    for page_num in range(len(pdf_document)):
+    # 処理設定（タイムアウト後の再試行時は問題のページとフォールバック処理を省略する）
+    policy = policy or {}
+    detection_only = policy.get("name") == "detection_only"
+    skip_pages = set(policy.get("skip_pages", []))
+    if page_text_index is None:
+        page_text_index = build_page_text_index(pdf_path, skip_pages)
+    
+    # 処理対象のページ（pagesが指定された場合はそのページのみ）
+    target_pages = [
+        page_num for page_num in range(len(pdf_document))
+        if pages is None or page_num + 1 in pages
+    ]
+    
+    # 表フィンガープリント -> 同じ内容の表データのリスト（ジオメトリも一致する表はレンダリングしない）
+    # 前回から再利用する表も登録しておき、それらと重複する表もレンダリングしない
+    known_tables = known_tables or []
+    table_fingerprints = defaultdict(list)
+    for table_info in known_tables:
+        if table_info.get("fingerprint"):
+            table_fingerprints[table_info["fingerprint"]].append(table_info)
+    skipped_duplicates = 0
+    
+    # スキャンページ（フォールバックのページ全体の画像化も行わない）
+    scanned_pages = set()
+    
+    for page_num in target_pages:
+        if page_num + 1 in skip_pages:
+            print(f"Skipped page {page_num+1} (timed out in a previous attempt)")
+            continue
+        report_page_progress(page_num + 1)
         page = pdf_document[page_num]
         
+        # スキャンページはベクターの表が無いため、ページ画像を領域分割して表の領域のみを切り出す
+        if is_scanned_page(page, page_text_index.get(str(page_num + 1), [])):
+            scanned_pages.add(page_num)
+            table_data.extend(extract_scanned_tables(page, page_num + 1, table_folder, pdf_filename))
+            continue
+        
         # 表を検出する
         table_finder = page.find_tables()
         tables = table_finder.tables if hasattr(table_finder, "tables") else []
@@ -133,6 +443,23 @@ def extract_tables_with_pymupdf(pdf_path, table_folder):
                 table_image_filename = f"【{os.path.splitext(pdf_filename)[0]}】page{page_num+1}_table{table_index+1}.png"
                 image_path = os.path.join(table_folder, table_image_filename)
                 
+                # レンダリング前にセル内容で重複チェック
+                fingerprint = get_table_fingerprint(table)
+                geometry = get_table_geometry(table, rect)
+                original = next(
+                    (table_info for table_info in table_fingerprints.get(fingerprint, [])
+                     if is_same_table_geometry(table_info.get("geometry"), geometry)),
+                    None
+                ) if fingerprint else None
+                if original:
+                    original["duplicates"].append({
+                        "path": image_path,
+                        "page_number": page_num + 1
+                    })
+                    skipped_duplicates += 1
+                    print(f"Skipped duplicate table {table_index+1} on page {page_num+1} (not rendered)")
+                    continue
+                
                 # 表を画像として保存
                 if save_table_as_image(page, rect, image_path):
                     print(f"Saved table {table_index+1} from page {page_num+1} as image")
@@ -140,7 +467,7 @@ def extract_tables_with_pymupdf(pdf_path, table_folder):
                     # 表データを記録
                     column_names = df.columns.tolist() if not df.empty else []
                     
-                    table_data.append({
+                    table_info = {
                         "image_path": image_path,
                         "filename": table_image_filename,
                         "page_number": page_num + 1,
@@ -153,16 +480,46 @@ def extract_tables_with_pymupdf(pdf_path, table_folder):
                             "y1": rect.y1
                         },
                         "column_names": column_names,
-                        "extraction_method": "pymupdf"
-                    })
+                        "extraction_method": "pymupdf",
+                        "fingerprint": fingerprint,
+                        "geometry": geometry,
+                        "duplicates": []
+                    }
+                    table_data.append(table_info)
+                    
+                    if fingerprint:
+                        table_fingerprints[fingerprint].append(table_info)
             except Exception as e:
                 print(f"Error processing table {table_index} on page {page_num+1}: {e}")
     
+    if skipped_duplicates:
+        print(f"Skipped rendering of {skipped_duplicates} duplicate tables")
+    
+    # 標準の方法で表が見つかったか（再利用する表も含めて判定する）
+    found_standard_tables = any(
+        table_info.get("extraction_method") in ("pymupdf", "scan_segment") for table_info in table_data + known_tables
+    )
+    
+    if found_standard_tables:
+        fallback_mode = "standard"
+    elif detection_only:
+        fallback_mode = "none"
+    else:
+        fallback_mode = "alternative"
+    # 前回がページ全体の画像化だった場合は、別のアプローチの結果を見るまで判定できない
+    if previous_mode is not None and fallback_mode != previous_mode and (fallback_mode, previous_mode) != ("alternative", "full_page"):
+        print(f"Fallback mode changed from '{previous_mode}' to '{fallback_mode}'")
+        report_page_progress(0)
+        return table_data, fallback_mode
+    
     # 別のアプローチを試す：テーブル検出のバックアップ方法
-    if len(table_data) == 0:
+    if fallback_mode == "alternative":
         print("No tables found with standard method, trying another approach...")
         
-        for page_num in range(len(pdf_document)):
+        for page_num in target_pages:
+            if page_num + 1 in skip_pages or page_num in scanned_pages:
+                continue
+            report_page_progress(page_num + 1)
             page = pdf_document[page_num]
             
             # 表を検出する別の方法
@@ -196,12 +553,25 @@ def extract_tables_with_pymupdf(pdf_path, table_folder):
             except Exception as e:
                 print(f"Error with alternative table detection on page {page_num+1}: {e}")
     
+        # 別のアプローチでも表が見つからない場合（再利用する表も含めて判定する）はページ全体を画像化する
+        if not any(
+            table_info.get("extraction_method") == "pymupdf_alternative" for table_info in table_data + known_tables
+        ):
+            fallback_mode = "full_page"
+        if previous_mode is not None and fallback_mode != previous_mode:
+            print(f"Fallback mode changed from '{previous_mode}' to '{fallback_mode}'")
+            report_page_progress(0)
+            return table_data, fallback_mode
+    
     # それでも表が見つからない場合は、pdfplumberまたはtabulaを使用する
-    if len(table_data) == 0:
+    if fallback_mode == "full_page":
         print("Still no tables found, trying tabula...")
         try:
             # ページ全体の画像を生成し、表領域を保存
-            for page_num in range(len(pdf_document)):
+            for page_num in target_pages:
+                if page_num + 1 in skip_pages or page_num in scanned_pages:
+                    continue
+                report_page_progress(page_num + 1)
                 # ページ全体を高解像度画像としてレンダリング
                 page = pdf_document[page_num]
                 pixmap = page.get_pixmap(matrix=fitz.Matrix(300/72, 300/72))
@@ -235,28 +605,40 @@ def extract_tables_with_pymupdf(pdf_path, table_folder):
         except Exception as e:
             print(f"Error using fallback method: {e}")
     
-    return table_data
+    report_page_progress(0)
+    return table_data, fallback_mode
 
 # 重複テーブル画像をチェックする関数
-def process_duplicate_tables(table_data):
+def process_duplicate_tables(table_data, known_tables=None):
     print("Checking for duplicate tables...")
     unique_tables = []
     duplicate_info = {}
+    known_tables = known_tables or []
     
-    # テーブルハッシュ用のディクショナリ
-    table_hashes = {}
+    # テーブルハッシュ -> (画像パス, ジオメトリ) のリスト（前回から再利用する表も登録しておく）
+    # 内容が同じでもジオメトリが異なる表は抽出時に別の表として残しているため、ここでも統合しない
+    table_hashes = defaultdict(list)
+    for table_info in known_tables:
+        if table_info.get("table_hash") not in (None, "error_hash"):
+            geometry = table_info.get("geometry") if table_info.get("fingerprint") else None
+            table_hashes[table_info["table_hash"]].append((table_info["image_path"], geometry))
     
     for i, table_info in enumerate(table_data):
         image_path = table_info["image_path"]
         
         try:
-            # 画像のハッシュを計算
-            image_hash = get_image_hash(image_path)
+            # セル内容のフィンガープリントがあればそれを使い、無ければ画像のハッシュを計算
+            image_hash = table_info.get("fingerprint") or get_image_hash(image_path)
+            geometry = table_info.get("geometry") if table_info.get("fingerprint") else None
             
-            # 重複チェック
-            if image_hash in table_hashes:
+            # 重複チェック（画像のハッシュで比較する表はジオメトリを持たない）
+            duplicate_reference = next(
+                (path for path, other in table_hashes.get(image_hash, [])
+                 if (geometry is None and other is None) or is_same_table_geometry(geometry, other)),
+                None
+            )
+            if duplicate_reference:
                 # 重複テーブルの情報を記録
-                duplicate_reference = table_hashes[image_hash]
                 if duplicate_reference not in duplicate_info:
                     duplicate_info[duplicate_reference] = []
                 
@@ -271,7 +653,7 @@ def process_duplicate_tables(table_data):
                 print(f"Removed duplicate table: {os.path.basename(image_path)}")
             else:
                 # イメージハッシュを登録
-                table_hashes[image_hash] = image_path
+                table_hashes[image_hash].append((image_path, geometry))
                 
                 # 一意のテーブル情報を保存
                 table_info["table_hash"] = image_hash
@@ -282,16 +664,16 @@ def process_duplicate_tables(table_data):
             table_info["table_hash"] = "error_hash"
             unique_tables.append(table_info)
     
-    # 重複情報をユニークテーブルに関連付ける
+    # 重複情報をユニークテーブルに関連付ける（抽出時にスキップした重複も保持する）
     for i, table_info in enumerate(unique_tables):
         image_path = table_info["image_path"]
-        if image_path in duplicate_info:
-            unique_tables[i]["duplicates"] = duplicate_info[image_path]
-        else:
-            unique_tables[i]["duplicates"] = []
+        duplicates = table_info.get("duplicates", [])
+        unique_tables[i]["duplicates"] = duplicates + duplicate_info.get(image_path, [])
+    for table_info in known_tables:
+        table_info["duplicates"] = table_info.get("duplicates", []) + duplicate_info.get(table_info["image_path"], [])
     
     print(f"Kept {len(unique_tables)} unique tables, removed {len(table_data) - len(unique_tables)} duplicates")
-    return unique_tables
+    return sorted(known_tables + unique_tables, key=lambda table_info: table_info["page_number"])
 
 # 表メタデータを保存する関数
 def save_table_metadata(table_data_list, json_folder, source_pdf):
@@ -300,6 +682,7 @@ def save_table_metadata(table_data_list, json_folder, source_pdf):
             table_filename = table_data["filename"]
             image_path = table_data["image_path"]
             page_number = table_data["page_number"]
+            context = table_data.get("context") or {}
             
             print(f"Processing table {i+1}/{len(table_data_list)}: {os.path.basename(image_path)} from page {page_number}")
             
@@ -330,6 +713,9 @@ def save_table_metadata(table_data_list, json_folder, source_pdf):
                 "source_pdf": os.path.splitext(source_pdf)[0],
                 "file_name": file_name,
                 "pdf_page_number": page_number,
+                "caption": context.get("caption"),
+                "section_heading": context.get("section_heading"),
+                "surrounding_text": context.get("surrounding_text", ""),
                 #"duplicate_appearances": duplicate_pages,
                 #"image_path": rel_image_path,
                 #"width": width,
@@ -367,49 +753,866 @@ def save_table_metadata(table_data_list, json_folder, source_pdf):
         except Exception as e:
             print(f"Error creating metadata for {table_data['filename']}: {e}")
 
+# PDFファイル名からシャード番号を決める関数（どのノードでも同じ結果になる）
+def get_shard_index(pdf_filename, num_shards):
+    digest = hashlib.sha1(pdf_filename.encode("utf-8")).hexdigest()
+    return int(digest, 16) % num_shards
+
+# シャードのマニフェストを保存するフォルダ
+def get_shard_manifest_dir():
+    manifest_dir = os.path.join(table_and_json_dir, "_shards")
+    os.makedirs(manifest_dir, exist_ok=True)
+    return manifest_dir
+
+# JSONを一時ファイル経由で書き込む関数（共有フォルダで途中の状態を読まれないようにする）
+def write_json_atomic(json_path, data):
+    temp_path = f"{json_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding='utf-8') as json_file:
+        json.dump(data, json_file, ensure_ascii=False, indent=4)
+    os.replace(temp_path, json_path)
+
+# シャードのマニフェストと重複インデックスを保存する関数
+def save_shard_manifest(shard, documents, failed):
+    """
+    シャード単位の処理結果をマニフェストとして保存する
+    
+    Args:
+        shard (tuple): (シャード番号, シャード数)
+        documents (dict): PDFファイル名 -> ユニークテーブルのリスト
+        failed (list): 処理に失敗したPDFファイル名
+    
+    Returns:
+        str: マニフェストのパス
+    """
+    shard_index, num_shards = shard
+    manifest_documents = {}
+    dedup_index = {}
+    
+    for pdf_file, unique_tables in documents.items():
+        doc_name = os.path.splitext(pdf_file)[0]
+        records = []
+        for table_data in unique_tables:
+            record = {
+                "file_name": table_data["filename"],
+                "page_number": table_data["page_number"],
+                "table_hash": table_data["table_hash"],
+                "duplicate_pages": [dup["page_number"] for dup in table_data.get("duplicates", [])]
+            }
+            records.append(record)
+            
+            # 重複インデックス（ハッシュ -> 最初に出現した表）
+            key = record["table_hash"]
+            if key and key != "error_hash" and key not in dedup_index:
+                dedup_index[key] = {"source_pdf": doc_name, "file_name": record["file_name"]}
+        
+        manifest_documents[pdf_file] = {"source_pdf": doc_name, "records": records}
+    
+    manifest = {
+        "shard": shard_index,
+        "num_shards": num_shards,
+        "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "documents": manifest_documents,
+        "failed": failed,
+        "dedup_index": dedup_index
+    }
+    
+    manifest_path = os.path.join(get_shard_manifest_dir(), f"table_shard_{shard_index}of{num_shards}.json")
+    write_json_atomic(manifest_path, manifest)
+    print(f"Saved shard manifest: {manifest_path}")
+    return manifest_path
+
+# 全シャードのマニフェストを統合し、シャード間の重複を解決する関数
+def merge_shard_manifests(num_shards):
+    """
+    シャードごとのマニフェストを1つに統合する
+    
+    同じハッシュを持つ表が複数のPDFにある場合は、PDFファイル名順で最初のものを
+    正とし、それ以外を cross_shard_duplicates に記録する（表画像自体は各PDFのフォルダに残す）
+    
+    Args:
+        num_shards (int): シャード数
+    
+    Returns:
+        dict: 統合したマニフェスト（シャードが揃っていない場合はNone）
+    """
+    manifest_dir = get_shard_manifest_dir()
+    manifests = []
+    for shard_index in range(num_shards):
+        manifest_path = os.path.join(manifest_dir, f"table_shard_{shard_index}of{num_shards}.json")
+        if not os.path.exists(manifest_path):
+            print(f"Missing shard manifest: {os.path.basename(manifest_path)}")
+            continue
+        with open(manifest_path, "r", encoding='utf-8') as manifest_file:
+            manifests.append(json.load(manifest_file))
+    
+    if len(manifests) != num_shards:
+        print(f"Found {len(manifests)}/{num_shards} shard manifests. Merge aborted.")
+        return None
+    
+    # シャードごとの隔離リストを統合
+    quarantine = []
+    for shard_index in range(num_shards):
+        quarantine_path = os.path.join(manifest_dir, f"table_quarantine_{shard_index}of{num_shards}.json")
+        if os.path.exists(quarantine_path):
+            with open(quarantine_path, "r", encoding='utf-8') as quarantine_file:
+                quarantine.extend(json.load(quarantine_file))
+    write_json_atomic(os.path.join(table_and_json_dir, "table_quarantine.json"), quarantine)
+    
+    # 各PDFはいずれか1つのシャードに割り当てられる（再実行などで重なった場合は番号の小さいシャードを優先）
+    documents = {}
+    failed = []
+    for manifest in manifests:
+        for pdf_file, document in manifest["documents"].items():
+            if pdf_file in documents:
+                print(f"  {pdf_file} appears in multiple shards; keeping shard {documents[pdf_file]['shard']}")
+                continue
+            documents[pdf_file] = dict(document, shard=manifest["shard"])
+        failed.extend(manifest.get("failed", []))
+    
+    # シャードをまたいだ重複を解決
+    dedup_index = {}
+    cross_shard_duplicates = []
+    for pdf_file in sorted(documents):
+        document = documents[pdf_file]
+        for record in document["records"]:
+            keys = [key for key in (record["table_hash"],) if key and key != "error_hash"]
+            reference = next((dedup_index[key] for key in keys if key in dedup_index), None)
+            if reference and reference["source_pdf"] != document["source_pdf"]:
+                cross_shard_duplicates.append({
+                    "source_pdf": document["source_pdf"],
+                    "file_name": record["file_name"],
+                    "duplicate_of": reference
+                })
+                continue
+            for key in keys:
+                dedup_index.setdefault(key, {"source_pdf": document["source_pdf"], "file_name": record["file_name"]})
+    
+    merged = {
+        "num_shards": num_shards,
+        "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "documents": documents,
+        "failed": sorted(set(failed)),
+        "dedup_index": dedup_index,
+        "cross_shard_duplicates": cross_shard_duplicates,
+        "quarantine": quarantine
+    }
+    
+    merged_path = os.path.join(table_and_json_dir, "table_manifest.json")
+    write_json_atomic(merged_path, merged)
+    print(f"Merged {num_shards} shard manifests ({len(documents)} PDFs, {len(cross_shard_duplicates)} cross-shard duplicates): {merged_path}")
+    return merged
+
+# ページのテキストレイアウトインデックスのキャッシュ（画像抽出と表抽出で共有する）
+# このバージョン・下のパターン・build_page_text_index のブロックの形式は PDFからimage抽出.py と
+# PDFからtable抽出.py で同じものを持っている。片方だけ変えるとお互いのキャッシュを作り直し続けるため、必ず両方を同時に変更すること
+PAGE_TEXT_INDEX_FILENAME = "_page_text_index.json"
+PAGE_TEXT_INDEX_VERSION = 3
+
+# キャプション（「図1…」「表2…」など）と見出しを判定するパターン
+# キャプションは番号の後に区切り（空白・コロン・句点）があるもののみ（「表1に示すとおり…」のような本文は除く）
+CAPTION_PATTERN = re.compile(
+    r"^\s*(図|表|Fig\.?|Figure|Table)\s*[0-9０-９]+([.．\-－][0-9０-９]+)*([\s:：．.](?![0-9０-９])|$)",
+    re.IGNORECASE
+)
+CAPTION_MAX_CHARS = 80
+# 番号付けの見出しは「第1章」「1.」「1.2」のような形のみ（「100 kPa…」「3.5 MPa…」のような本文や「2023.4.1 改訂」のような日付は除く）
+# 番号の無い見出しは build_page_text_index でフォントサイズと太字から判定する
+HEADING_PATTERN = re.compile(
+    r"^\s*(?!(19|20|１９|２０)[0-9０-９]{2}\s*[.．/／]\s*[0-9０-９]{1,2}(?![0-9０-９]))"
+    r"(第\s*[0-9０-９一二三四五六七八九十]+\s*[章節項]"
+    r"|[0-9０-９]+([.．][0-9０-９]+)*[.．](?![0-9０-９])\s*\S"
+    r"|[0-9０-９]+([.．][0-9０-９]+)+\s+[^\s0-9０-９A-Za-z%％°℃.．])"
+)
+
+# ページのテキストレイアウトインデックスを作成する関数
+def build_page_text_index(pdf_path, skip_pages=()):
+    """
+    page.get_text("dict") を1ページ1回だけ実行し、テキストブロックの位置と種類を記録する
+    
+    Args:
+        pdf_path (str): PDFファイルのパス
+        skip_pages (list): 前回の試行でタイムアウトしたためテキストを取得しないページ番号
+    
+    Returns:
+        dict: ページ番号(str) -> テキストブロックのリスト
+    """
+    pdf_document = fitz.open(pdf_path)
+    pages = {}
+    size_counts = defaultdict(int)
+    
+    for page_num in range(len(pdf_document)):
+        if page_num + 1 in skip_pages:
+            pages[str(page_num + 1)] = []
+            continue
+        report_page_progress(page_num + 1)
+        page = pdf_document.load_page(page_num)
+        blocks = []
+        for block in page.get_text("dict").get("blocks", []):
+            # テキストブロック以外（画像ブロック）は対象外
+            if block.get("type", 0) != 0:
+                continue
+            
+            lines = []
+            max_size = 0
+            is_bold = True
+            for line in block.get("lines", []):
+                spans = [span for span in line.get("spans", []) if span.get("text", "").strip()]
+                if not spans:
+                    continue
+                lines.append("".join(span["text"] for span in spans).strip())
+                for span in spans:
+                    size = round(span.get("size", 0), 1)
+                    size_counts[size] += len(span["text"])
+                    max_size = max(max_size, size)
+                    # フラグの16は太字
+                    is_bold = is_bold and bool(span.get("flags", 0) & 16)
+            
+            if not lines:
+                continue
+            
+            blocks.append({
+                "bbox": [round(v, 1) for v in block["bbox"]],
+                "text": " ".join(lines),
+                "size": max_size,
+                "bold": is_bold
+            })
+        
+        # 上から順に並べておく（検索時に上方向の探索を容易にする）
+        blocks.sort(key=lambda b: (b["bbox"][1], b["bbox"][0]))
+        pages[str(page_num + 1)] = blocks
+    
+    report_page_progress(0)
+    pdf_document.close()
+    
+    # 最も文字数の多いフォントサイズを本文サイズとし、見出しとキャプションを判定
+    body_size = max(size_counts, key=size_counts.get) if size_counts else 0
+    for blocks in pages.values():
+        for block in blocks:
+            text = block["text"]
+            block["is_caption"] = len(text) <= CAPTION_MAX_CHARS and bool(CAPTION_PATTERN.match(text))
+            block["is_heading"] = not block["is_caption"] and len(text) <= 60 and (
+                (body_size and block["size"] >= body_size * 1.2)
+                or bool(HEADING_PATTERN.match(text))
+                or (block["bold"] and len(text) <= 30)
+            )
+    
+    return pages
+
+# ページのテキストレイアウトインデックスを読み込む関数（無ければ作成してキャッシュする）
+def load_page_text_index(pdf_path, doc_folder, skip_pages=()):
+    """
+    ドキュメントフォルダにキャッシュしたインデックスを読み込む
+    キャッシュが無い、またはPDFが更新されている場合は作成し直す
+    
+    Args:
+        pdf_path (str): PDFファイルのパス
+        doc_folder (str): ドキュメントフォルダのパス
+        skip_pages (list): テキストを取得しないページ番号
+    
+    Returns:
+        dict: ページ番号(str) -> テキストブロックのリスト
+    """
+    stat = os.stat(pdf_path)
+    source = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "version": PAGE_TEXT_INDEX_VERSION,
+        "skipped_pages": sorted(skip_pages)
+    }
+    index_path = os.path.join(doc_folder, PAGE_TEXT_INDEX_FILENAME)
+    
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "r", encoding='utf-8') as index_file:
+                cached = json.load(index_file)
+            if cached.get("source") == source:
+                print(f"Loaded page text index: {index_path}")
+                return cached["pages"]
+        except Exception as e:
+            print(f"Error loading page text index: {e}")
+    
+    pages = build_page_text_index(pdf_path, skip_pages)
+    write_json_atomic(index_path, {"source": source, "pages": pages})
+    print(f"Created page text index: {index_path}")
+    return pages
+
+# 図表の周辺のキャプション・見出し・本文を取得する関数
+def get_artifact_context(page_text_index, page_number, position, caption_prefix, artifact_rects=None, margin=100, max_chars=400):
+    """
+    図表の位置に最も近いキャプション、直前の見出し、周辺の本文を取得する
+    
+    Args:
+        page_text_index (dict): load_page_text_index の戻り値
+        page_number (int): ページ番号（1始まり）
+        position (dict): 図表の位置 {"x0", "y0", "x1", "y1"}（不明な場合はNone）
+        caption_prefix (str): 優先するキャプションの接頭辞（"図" または "表"）
+        artifact_rects (dict): ページ番号 -> 図表の位置のリスト（この中のテキストは見出しとみなさない）
+        margin (float): 周辺の本文として扱う上下の距離（pt）
+        max_chars (int): 周辺の本文の最大文字数
+    
+    Returns:
+        dict: {"caption", "section_heading", "surrounding_text"}
+    """
+    blocks = page_text_index.get(str(page_number), [])
+    top = position["y0"] if position else float("inf")
+    artifact_rects = artifact_rects or {}
+    
+    def is_heading(block, page):
+        # 表のヘッダーセルなど、図表の内側にあるテキストは見出しとしない
+        cx, cy = (block["bbox"][0] + block["bbox"][2]) / 2, (block["bbox"][1] + block["bbox"][3]) / 2
+        return block["is_heading"] and not any(
+            rect["x0"] <= cx <= rect["x1"] and rect["y0"] <= cy <= rect["y1"]
+            for rect in artifact_rects.get(page, [])
+        )
+    
+    # 直前の見出し（同じページに無ければ前のページを遡る）
+    section_heading = next((b["text"] for b in reversed(blocks) if is_heading(b, page_number) and b["bbox"][3] <= top), None)
+    previous_page = page_number - 1
+    while section_heading is None and previous_page >= 1:
+        section_heading = next((b["text"] for b in reversed(page_text_index.get(str(previous_page), [])) if is_heading(b, previous_page)), None)
+        previous_page -= 1
+    
+    if not position:
+        return {"caption": None, "section_heading": section_heading, "surrounding_text": ""}
+    
+    x0, y0, x1, y1 = position["x0"], position["y0"], position["x1"], position["y1"]
+    
+    def vertical_gap(bbox):
+        return max(bbox[1] - y1, y0 - bbox[3], 0)
+    
+    def overlaps_horizontally(bbox):
+        return bbox[0] < x1 and bbox[2] > x0
+    
+    def is_inside(bbox):
+        # ブロックの中心が図表の内側にあれば図表自体のテキストとみなす
+        cx, cy = (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
+        return x0 <= cx <= x1 and y0 <= cy <= y1
+    
+    # 最も近いキャプション（同じ種類を優先）
+    captions = [b for b in blocks if b["is_caption"] and not is_inside(b["bbox"]) and vertical_gap(b["bbox"]) <= margin]
+    captions.sort(key=lambda b: (
+        not b["text"].lstrip().startswith(caption_prefix),
+        not overlaps_horizontally(b["bbox"]),
+        vertical_gap(b["bbox"])
+    ))
+    caption = captions[0]["text"] if captions else None
+    
+    # 周辺の本文（近い順）
+    nearby = [
+        b for b in blocks
+        if not b["is_caption"] and not b["is_heading"] and not is_inside(b["bbox"])
+        and overlaps_horizontally(b["bbox"]) and vertical_gap(b["bbox"]) <= margin
+    ]
+    nearby.sort(key=lambda b: vertical_gap(b["bbox"]))
+    surrounding_text = ""
+    for block in nearby:
+        if len(surrounding_text) >= max_chars:
+            break
+        surrounding_text = f"{surrounding_text} {block['text']}".strip()
+    
+    return {
+        "caption": caption,
+        "section_heading": section_heading,
+        "surrounding_text": surrounding_text[:max_chars]
+    }
+
+# ページ単位の前回の処理結果（改訂版PDFで変更の無いページの成果物を再利用するために保存する）
+PAGE_STATE_FILENAME = "_page_state_table.json"
+
+# 各ページの内容からフィンガープリントを計算する関数
+def compute_page_fingerprints(pdf_path, page_text_index, skip_pages=()):
+    """
+    コンテンツストリーム・画像データ・テキストのハッシュから各ページのフィンガープリントを計算する
+    画像はxref番号ではなくデータのハッシュを使うため、改訂でxrefが振り直されても一致する
+    テキストはページのテキストレイアウトインデックスから取得する（テキストの抽出は1ページ1回のみ）
+    
+    Args:
+        pdf_path (str): PDFファイルのパス
+        page_text_index (dict): load_page_text_index の戻り値
+        skip_pages (list): 前回の試行でタイムアウトしたため計算しないページ番号
+    
+    Returns:
+        dict: ページ番号(str) -> フィンガープリント（計算できなかったページ・スキップしたページはNone）
+    """
+    pdf_document = fitz.open(pdf_path)
+    image_digests = {}
+    fingerprints = {}
+    
+    for page_num in range(len(pdf_document)):
+        if page_num + 1 in skip_pages:
+            fingerprints[str(page_num + 1)] = None
+            continue
+        report_page_progress(page_num + 1)
+        try:
+            page = pdf_document.load_page(page_num)
+            content_hash = hashlib.md5(page.read_contents()).hexdigest()
+            
+            # ページ内の画像（とSMask）のデータのハッシュ
+            page_images = []
+            for img in page.get_images(full=True):
+                for xref in (img[0], img[1]):
+                    if xref and xref not in image_digests:
+                        image_digests[xref] = hashlib.md5(pdf_document.xref_stream_raw(xref)).hexdigest()
+                page_images.append([image_digests[img[0]], image_digests.get(img[1])])
+            
+            text_blocks = [[block["bbox"], block["text"]] for block in page_text_index.get(str(page_num + 1), [])]
+            text_hash = hashlib.md5(json.dumps(text_blocks, ensure_ascii=False).encode("utf-8")).hexdigest()
+            signature = [content_hash, page_images, text_hash, list(page.rect), page.rotation]
+            fingerprints[str(page_num + 1)] = hashlib.md5(json.dumps(signature).encode("utf-8")).hexdigest()
+        except Exception as e:
+            print(f"Error fingerprinting page {page_num+1}: {e}")
+            fingerprints[str(page_num + 1)] = None
+    
+    report_page_progress(0)
+    pdf_document.close()
+    return fingerprints
+
+# 前回の処理結果を読み込む関数
+def load_page_state(doc_folder):
+    state_path = os.path.join(doc_folder, PAGE_STATE_FILENAME)
+    if not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path, "r", encoding='utf-8') as state_file:
+            return json.load(state_file)
+    except Exception as e:
+        print(f"Error loading page state: {e}")
+        return None
+
+# 今回の処理結果を保存する関数
+def save_page_state(doc_folder, page_fingerprints, records, policy_name, fallback_mode):
+    write_json_atomic(os.path.join(doc_folder, PAGE_STATE_FILENAME), {
+        "policy": policy_name,
+        "fallback_mode": fallback_mode,
+        "page_count": len(page_fingerprints),
+        "pages": page_fingerprints,
+        "records": records
+    })
+
+# 前回の処理結果と比較し、成果物を再利用できるページを求める関数
+def find_reusable_pages(page_fingerprints, previous_state, policy_name, table_folder):
+    """
+    同じページ番号でフィンガープリントが一致し、成果物が残っているページを再利用対象とする
+    
+    Args:
+        page_fingerprints (dict): compute_page_fingerprints の戻り値
+        previous_state (dict): load_page_state の戻り値
+        policy_name (str): 今回の処理設定（前回と異なる場合は再利用しない）
+        table_folder (str): 成果物の画像フォルダ
+    
+    Returns:
+        set: 再利用できるページ番号
+    """
+    if not previous_state or previous_state.get("policy") != policy_name:
+        return set()
+    
+    previous_pages = previous_state.get("pages", {})
+    reusable_pages = {
+        int(page) for page, fingerprint in page_fingerprints.items()
+        if fingerprint and previous_pages.get(page) == fingerprint
+    }
+    
+    records = previous_state.get("records", [])
+    for record in records:
+        if not os.path.exists(os.path.join(table_folder, record["filename"])):
+            reusable_pages.discard(record["page_number"])
+    
+    # 重複として削除した表は別ページの表を参照しているため、
+    # 参照先・参照元のどちらかのページを処理し直す場合は両方とも処理し直す
+    changed = True
+    while changed:
+        changed = False
+        for record in records:
+            pages = {record["page_number"]} | {dup["page_number"] for dup in record.get("duplicates", [])}
+            if pages & reusable_pages and not pages <= reusable_pages:
+                reusable_pages -= pages
+                changed = True
+    
+    return reusable_pages
+
+# 図表の位置をページごとにまとめる関数（見出しの判定から図表の内側のテキストを除くため）
+def collect_artifact_rects(doc_folder, records):
+    """
+    今回の記録と、画像抽出・表抽出それぞれの前回の処理結果（_page_state_*.json）から図表の位置を集める
+    
+    Returns:
+        dict: ページ番号 -> 図表の位置のリスト
+    """
+    all_records = list(records)
+    for state_kind in ("image", "table"):
+        state_path = os.path.join(doc_folder, f"_page_state_{state_kind}.json")
+        if not os.path.exists(state_path):
+            continue
+        try:
+            with open(state_path, "r", encoding='utf-8') as state_file:
+                all_records.extend(json.load(state_file).get("records", []))
+        except Exception as e:
+            print(f"Error loading {os.path.basename(state_path)}: {e}")
+    
+    artifact_rects = defaultdict(list)
+    for record in all_records:
+        if record.get("position"):
+            artifact_rects[record["page_number"]].append(record["position"])
+    return artifact_rects
+
+# 1つのPDFを処理する関数
+def process_document(pdf_dir, pdf_file, policy=None):
+    """
+    PDFから表を抽出し、重複を除いてメタデータを保存する
+    
+    Args:
+        pdf_dir (str): PDFが配置されているフォルダ
+        pdf_file (str): PDFファイル名
+        policy (dict): 処理設定 {"name": PROCESSING_POLICIESの値, "skip_pages": スキップするページ番号}
+    
+    Returns:
+        list: ユニークな表のリスト
+    """
+    policy = policy or {"name": "full", "skip_pages": []}
+    pdf_path = os.path.join(pdf_dir, pdf_file)
+    print(f"\n{'='*60}\nProcessing PDF: {pdf_file}")
+    
+    # フォルダ構造を作成
+    doc_folder, table_folder, json_folder = create_folder_structure(pdf_file)
+    print(f"Created folders:\n  Document: {doc_folder}\n  Table Images: {table_folder}\n  JSON: {json_folder}")
+    
+    # スキップするページについて、前回の試行で出力された表画像を削除
+    skip_pages = policy.get("skip_pages", [])
+    for page_number in skip_pages:
+        remove_page_artifacts(table_folder, json_folder, pdf_file, page_number)
+    
+    # ページのフィンガープリントを前回の処理結果と比較し、変更の無いページは表画像とJSONを再利用
+    page_text_index = load_page_text_index(pdf_path, doc_folder, skip_pages)
+    page_fingerprints = compute_page_fingerprints(pdf_path, page_text_index, skip_pages)
+    previous_state = load_page_state(doc_folder)
+    reusable_pages = find_reusable_pages(page_fingerprints, previous_state, policy["name"], table_folder)
+    reused_tables = []
+    if previous_state:
+        reused_tables = [
+            dict(record, image_path=os.path.join(table_folder, record["filename"]))
+            for record in previous_state.get("records", [])
+            if record["page_number"] in reusable_pages
+        ]
+        # 処理し直すページの古い表画像を削除
+        for page_number in range(1, max(previous_state.get("page_count", 0), len(page_fingerprints)) + 1):
+            if page_number not in reusable_pages:
+                remove_page_artifacts(table_folder, json_folder, pdf_file, page_number)
+    pages_to_process = {int(page) for page in page_fingerprints} - reusable_pages
+    if reusable_pages:
+        print(f"Reusing {len(reused_tables)} tables from {len(reusable_pages)} unchanged pages, processing {len(pages_to_process)} pages")
+    
+    # PDFから表を抽出
+    previous_mode = previous_state.get("fallback_mode") if reusable_pages else None
+    table_data_list, fallback_mode = extract_tables_with_pymupdf(
+        pdf_path, table_folder, policy, pages_to_process, reused_tables, page_text_index, previous_mode
+    )
+    
+    # フォールバックの種類は文書全体で決まるため、前回と異なる場合は再利用をやめて全ページを処理し直す
+    if reusable_pages and fallback_mode != previous_mode:
+        print(f"Table fallback mode changed, reprocessing all pages of {pdf_file}")
+        for page_number in range(1, len(page_fingerprints) + 1):
+            remove_page_artifacts(table_folder, json_folder, pdf_file, page_number)
+        reusable_pages = set()
+        reused_tables = []
+        pages_to_process = {int(page) for page in page_fingerprints}
+        table_data_list, fallback_mode = extract_tables_with_pymupdf(
+            pdf_path, table_folder, policy, pages_to_process, [], page_text_index
+        )
+    print(f"Extracted {len(table_data_list)} tables from {pdf_file}")
+    
+    # 次回の改訂版との比較用の処理結果（スキップしたページは次回必ず処理する）
+    processed_fingerprints = {
+        page: (None if int(page) in skip_pages else fingerprint) for page, fingerprint in page_fingerprints.items()
+    }
+    
+    if len(table_data_list) == 0 and not reused_tables:
+        print(f"No tables found in {pdf_file}")
+        save_page_state(doc_folder, processed_fingerprints, [], policy["name"], fallback_mode)
+        return []
+    
+    # 重複チェックと処理
+    unique_tables = process_duplicate_tables(table_data_list, known_tables=reused_tables)
+    
+    # 新しく抽出した表のみJSONを作成する（再利用する表はJSONが無くなっている場合のみ）
+    reused_paths = {table_data["image_path"] for table_data in reused_tables}
+    new_tables = [
+        table_data for table_data in unique_tables
+        if table_data["image_path"] not in reused_paths
+        or not os.path.exists(os.path.join(json_folder, f"{os.path.splitext(table_data['filename'])[0]}.json"))
+    ]
+    
+    # ページのテキストから各表のキャプション・見出し・周辺の本文を取得
+    if new_tables:
+        artifact_rects = collect_artifact_rects(doc_folder, table_data_list + reused_tables)
+        for table_data in new_tables:
+            table_data["context"] = get_artifact_context(
+                page_text_index, table_data["page_number"], table_data.get("position"), "表", artifact_rects
+            )
+    
+    # 各表のメタデータをJSONファイルとして保存
+    save_table_metadata(new_tables, json_folder, pdf_file)
+    
+    save_page_state(doc_folder, processed_fingerprints, unique_tables, policy["name"], fallback_mode)
+    return unique_tables
+
+# ワーカープロセス内で現在処理中のページを親プロセスに知らせるための共有配列
+_page_progress = None
+
+# 処理中のページ番号を記録する関数（0はページ処理外）
+def report_page_progress(page_number):
+    if _page_progress is not None:
+        _page_progress[0] = page_number
+        _page_progress[1] = time.time()
+
+# 前回の試行で途中まで出力された、スキップ対象ページの成果物を削除する関数
+def remove_page_artifacts(table_folder, json_folder, pdf_file, page_number):
+    prefix = f"【{os.path.splitext(pdf_file)[0]}】page{page_number}_"
+    for folder in (table_folder, json_folder):
+        for file_name in os.listdir(folder):
+            # 同じフォルダにある画像抽出の出力（_img）は対象外
+            if file_name.startswith(prefix) and "table" in file_name[len(prefix):]:
+                os.remove(os.path.join(folder, file_name))
+                print(f"Removed partial output: {file_name}")
+
+# 失敗した試行で出力された成果物を削除する関数（再試行・隔離の前に呼ぶ）
+def remove_attempt_artifacts(pdf_file, attempt_start):
+    """
+    試行の開始以降に書き込まれた表画像・JSONを削除する
+    強制終了された試行が残したファイル（ページ全体の表画像など）が再試行後の成果物に混ざらないようにする
+    （それ以前の処理で出力された成果物は再利用のために残す）
+    
+    Args:
+        pdf_file (str): PDFファイル名
+        attempt_start (float): 試行を開始した時刻（time.time()）
+    """
+    doc_name = os.path.splitext(pdf_file)[0]
+    doc_folder = os.path.join(table_and_json_dir, doc_name)
+    if not os.path.isdir(doc_folder):
+        return
+    
+    # 同じフォルダにある画像抽出の出力（_img）は対象外
+    # ファイルの更新時刻は時計より粗い精度で記録されるため、余裕を持たせて比較する
+    written_since = attempt_start - 2.0
+    pattern = re.compile(rf"^{re.escape(f'【{doc_name}】')}page\d+_.*table")
+    for folder_name in ("Image", "JSON"):
+        folder = os.path.join(doc_folder, folder_name)
+        if not os.path.isdir(folder):
+            continue
+        for file_name in os.listdir(folder):
+            file_path = os.path.join(folder, file_name)
+            if pattern.match(file_name) and os.path.getmtime(file_path) >= written_since:
+                os.remove(file_path)
+                print(f"Removed output of failed attempt: {file_name}")
+
+# ワーカープロセスで1つのPDFを処理する関数
+def document_worker(pdf_dir, pdf_file, output_dir, policy, progress, result_queue):
+    global table_and_json_dir, _page_progress
+    table_and_json_dir = output_dir
+    _page_progress = progress
+    try:
+        result_queue.put(("ok", process_document(pdf_dir, pdf_file, policy)))
+    except Exception as e:
+        result_queue.put(("error", str(e)))
+
+# 1つのPDFを別プロセスで処理し、制限時間を超えたら強制終了する関数
+def run_document_in_subprocess(pdf_dir, pdf_file, policy):
+    """
+    Returns:
+        tuple: (結果の種類, 内容)
+            ("ok", ユニークな表のリスト) / ("error", エラー内容) / ("crashed", 終了コード)
+            ("page_timeout", ページ番号) / ("document_timeout", 処理中だったページ番号)
+    """
+    progress = multiprocessing.Array("d", [0, 0.0])
+    result_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=document_worker,
+        args=(pdf_dir, pdf_file, table_and_json_dir, policy, progress, result_queue)
+    )
+    process.start()
+    start_time = time.time()
+    
+    try:
+        while True:
+            try:
+                # 結果はプロセス終了前に受け取る（大きな結果でキューが詰まらないようにする）
+                result = result_queue.get(timeout=1.0)
+                process.join()
+                return result
+            except queue.Empty:
+                pass
+            
+            if not process.is_alive():
+                process.join()
+                try:
+                    return result_queue.get(timeout=1.0)
+                except queue.Empty:
+                    return "crashed", process.exitcode
+            
+            now = time.time()
+            page_number, page_start = int(progress[0]), progress[1]
+            if page_number and now - page_start > PAGE_TIMEOUT:
+                print(f"Page {page_number} of {pdf_file} exceeded {PAGE_TIMEOUT}s. Killing worker...")
+                return "page_timeout", page_number
+            if now - start_time > DOCUMENT_TIMEOUT:
+                print(f"{pdf_file} exceeded {DOCUMENT_TIMEOUT}s. Killing worker...")
+                return "document_timeout", page_number
+    finally:
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+# 制限時間を設けてPDFを処理し、失敗した場合は低コストの設定で再試行する関数
+def process_document_with_watchdog(pdf_dir, pdf_file):
+    """
+    PROCESSING_POLICIES の順に設定を下げながら最大 MAX_ATTEMPTS 回試行する
+    タイムアウトしたページは次の試行からスキップする
+    
+    Returns:
+        tuple: (ユニークな表のリスト（失敗した場合はNone）, 隔離リストのエントリ（問題が無ければNone）)
+    """
+    skip_pages = []
+    attempts = []
+    
+    for attempt in range(MAX_ATTEMPTS):
+        policy = {
+            "name": PROCESSING_POLICIES[min(attempt, len(PROCESSING_POLICIES) - 1)],
+            "skip_pages": list(skip_pages)
+        }
+        if attempt > 0:
+            print(f"Retrying {pdf_file} with policy '{policy['name']}' (skip pages: {skip_pages or 'none'})")
+        
+        attempt_start = time.time()
+        if ISOLATE_DOCUMENTS:
+            status, detail = run_document_in_subprocess(pdf_dir, pdf_file, policy)
+        else:
+            try:
+                status, detail = "ok", process_document(pdf_dir, pdf_file, policy)
+            except Exception as e:
+                status, detail = "error", str(e)
+        
+        if status == "ok":
+            quarantine_entry = None
+            if skip_pages:
+                quarantine_entry = {
+                    "source_pdf": pdf_file,
+                    "status": "partial",
+                    "skipped_pages": skip_pages,
+                    "attempts": attempts,
+                    "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                }
+            return detail, quarantine_entry
+        
+        print(f"Attempt {attempt+1} for {pdf_file} failed: {status} ({detail})")
+        attempts.append({"policy": policy["name"], "result": status, "detail": detail})
+        remove_attempt_artifacts(pdf_file, attempt_start)
+        if status in ("page_timeout", "document_timeout") and detail and detail not in skip_pages:
+            skip_pages.append(detail)
+    
+    return None, {
+        "source_pdf": pdf_file,
+        "status": "failed",
+        "skipped_pages": skip_pages,
+        "attempts": attempts,
+        "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+# 処理に問題があったPDFを隔離リストとして保存する関数
+def save_quarantine(quarantine, shard=None):
+    if shard:
+        shard_index, num_shards = shard
+        quarantine_path = os.path.join(get_shard_manifest_dir(), f"table_quarantine_{shard_index}of{num_shards}.json")
+    else:
+        quarantine_path = os.path.join(table_and_json_dir, "table_quarantine.json")
+    write_json_atomic(quarantine_path, quarantine)
+    print(f"Saved quarantine list ({len(quarantine)} PDFs): {quarantine_path}")
+
 # フォルダ内の全PDFファイルを処理
-def process_pdf_folder(pdf_dir):
+def process_pdf_folder(pdf_dir, shard=None):
+    """
+    フォルダ内のPDFファイルを処理する
+    
+    Args:
+        pdf_dir (str): PDFが配置されているフォルダ
+        shard (tuple): (シャード番号, シャード数)。指定時は担当分のPDFのみ処理し、マニフェストを保存する
+    """
     # PDFフォルダ内のPDFファイルを検索
-    pdf_files = [f for f in os.listdir(pdf_dir) if f.lower().endswith('.pdf')]
+    pdf_files = sorted(f for f in os.listdir(pdf_dir) if f.lower().endswith('.pdf'))
+    
+    if shard:
+        shard_index, num_shards = shard
+        pdf_files = [f for f in pdf_files if get_shard_index(f, num_shards) == shard_index]
+        print(f"Shard {shard_index}/{num_shards}: assigned {len(pdf_files)} PDF files")
     
     if not pdf_files:
         print(f"No PDF files found in {pdf_dir}")
+        if shard:
+            save_shard_manifest(shard, {}, [])
+            save_quarantine([], shard)
         return
     
     print(f"Found {len(pdf_files)} PDF files to process")
     
-    # 各PDFファイルを処理
+    # シャードのマニフェスト用に処理結果を記録
+    documents = {}
+    failed = []
+    quarantine = []
+    
+    # 各PDFファイルを処理（1文書ずつ別プロセスで実行し、時間がかかりすぎる場合は打ち切る）
     for pdf_file in pdf_files:
         try:
-            pdf_path = os.path.join(pdf_dir, pdf_file)
-            print(f"\n{'='*60}\nProcessing PDF: {pdf_file}")
-            
-            # フォルダ構造を作成
-            doc_folder, table_folder, json_folder = create_folder_structure(pdf_file)
-            print(f"Created folders:\n  Document: {doc_folder}\n  Table Images: {table_folder}\n  JSON: {json_folder}")
-            
-            # PDFから表を抽出
-            table_data_list = extract_tables_with_pymupdf(pdf_path, table_folder)
-            print(f"Extracted {len(table_data_list)} tables from {pdf_file}")
-            
-            if len(table_data_list) > 0:
-                # 重複チェックと処理
-                unique_tables = process_duplicate_tables(table_data_list)
-                
-                # 各表のメタデータをJSONファイルとして保存
-                save_table_metadata(unique_tables, json_folder, pdf_file)
+            unique_tables, quarantine_entry = process_document_with_watchdog(pdf_dir, pdf_file)
+            if quarantine_entry:
+                quarantine.append(quarantine_entry)
+            if unique_tables is None:
+                print(f"Quarantined PDF {pdf_file}")
+                failed.append(pdf_file)
             else:
-                print(f"No tables found in {pdf_file}")
+                documents[pdf_file] = unique_tables
             
         except Exception as e:
             print(f"Error processing PDF {pdf_file}: {str(e)}")
+            failed.append(pdf_file)
+    
+    save_quarantine(quarantine, shard)
+    if shard:
+        save_shard_manifest(shard, documents, failed)
+
+# "i/N" 形式のシャード指定を解析する関数
+def parse_shard(value):
+    try:
+        shard_index, num_shards = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}' (expected i/N)")
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}' (0 <= i < N)")
+    return shard_index, num_shards
 
 # メイン処理
 if __name__ == "__main__":
+    # exe化した場合にワーカープロセスを起動できるようにする
+    multiprocessing.freeze_support()
+    
+    parser = argparse.ArgumentParser(description="PDFから表を抽出し、JSONメタデータを作成する")
+    parser.add_argument("pdf_dir", nargs="?", default=pdf_dir, help="PDFが配置されているフォルダ")
+    parser.add_argument("--shard", type=parse_shard, help="担当シャード（i/N 形式、iは0始まり）")
+    parser.add_argument("--merge-shards", type=int, metavar="N", help="N個のシャードのマニフェストを統合する")
+    args = parser.parse_args()
+    
+    # 引数でフォルダが指定された場合は出力先も合わせる
+    if args.pdf_dir != pdf_dir:
+        pdf_dir = args.pdf_dir
+        root_output_dir = os.path.dirname(os.path.abspath(pdf_dir))
+        table_and_json_dir = os.path.join(root_output_dir, "ImageAndJSON")
+        os.makedirs(table_and_json_dir, exist_ok=True)
+    
     try:
-        # フォルダ内の全PDFを処理
-        process_pdf_folder(pdf_dir)
-        print("\nProcessing complete. All PDFs have been processed.")
-        print(f"Results are saved in: {table_and_json_dir}")
+        if args.merge_shards:
+            # シャードのマニフェストを統合
+            merge_shard_manifests(args.merge_shards)
+        else:
+            # フォルダ内の全PDFを処理
+            process_pdf_folder(pdf_dir, shard=args.shard)
+            print("\nProcessing complete. All PDFs have been processed.")
+            print(f"Results are saved in: {table_and_json_dir}")
     except Exception as e:
         print(f"Error during processing: {e}")
\ No newline at end of file